@@ -1,19 +1,68 @@
 import psycopg2
 import json
-import queue
-from preprocessing import QueryPlanGenerator
+import math
+import statistics
+from collections import Counter, deque
+from functools import lru_cache
+from preprocessing import QueryPlanGenerator, getOperatorName, getPlanName, getSpill, default_seqpage_cost, default_randompage_cost, \
+    gather_node_types
+
+# Nodes that an operator adds below itself to do its work, counted in the time of the operator
+operator_helper_types = {"Hash", "Sort", "Incremental Sort", "Materialize", "Memoize"}
+
+# Operators explained by comparing the QEP with the AQPs that turn them off
+explained_operators = {"HashAggregate", "MixedAggregate", "Sort", "Incremental Sort", "Materialize", "Memoize"}
+
+# Number of nodes in the ranked list of the hottest nodes
+default_hot_nodes = 5
+
+# Nodes whose actual rows are this many times more or fewer than the planner estimated are flagged
+default_misestimate_factor = 10
+
+# Confidence with which a QEP node measured over repeated runs must be faster than an AQP node to be
+# described as faster. Each plan needs at least 3 runs to reach 95%
+default_confidence = 0.95
+
+# The processes of a parallel subtree are unevenly split when the slowest takes this many times the average
+parallel_imbalance_factor = 1.25
 
 class Node(object):
     """
     The Node class represents an individual node on a QEP Tree
     """
+    # Slots keep nodes small, plans can have thousands of them
+    __slots__ = ("node_type", "node_cost", "row_number", "relation_name", "group_key", "sort_method", "sort_key",
+                "index_name", "index_condition", "hash_condition", "merge_condition", "rows_filtered",
+                "recheck_condition", "estimated_cost", "inclusive_time", "timed_out", "annotation", "children",
+                "alias", "position", "subtree_start", "relations",
+                "planning_time", "execution_time", "jit_time", "parent_relationship", "loops", "actual_rows",
+                "exclusive_time", "estimated_exclusive_cost", "strategy", "settings",
+                "shared_hit_blocks", "shared_read_blocks", "shared_written_blocks",
+                "local_hit_blocks", "local_read_blocks", "local_written_blocks", "io_read_time", "io_write_time",
+                "run_times", "exclusive_run_times", "spill", "sort_space_used", "hash_batches", "original_hash_batches",
+                "peak_memory_usage", "disk_usage", "parallel_aware", "workers_planned", "workers_launched", "worker_times",
+                "processes")
+
     def __init__(self, node_type, node_cost, row_number, relation_name, 
                 group_key, sort_method, sort_key, index_name, index_condition,
-                hash_condition, merge_condition, rows_filtered, recheck_condition):
+                hash_condition, merge_condition, rows_filtered, recheck_condition,
+                estimated_cost=None, inclusive_time=None, timed_out=None, alias=None, parent_relationship=None,
+                loops=None, actual_rows=None, strategy=None):
         self.node_type = node_type
-        self.node_cost = node_cost
-        self.row_number = row_number
+        self.strategy = strategy # Strategy of Aggregate and SetOp nodes, such as Hashed or Sorted
+        self.node_cost = node_cost # The inclusive time when the plan was analyzed, otherwise the estimated cost
+        self.estimated_cost = estimated_cost # Estimated total cost of the node and its subtree
+        self.inclusive_time = inclusive_time # Actual time in ms of the node and its subtree over the loops of one process
+        self.loops = loops
+        self.timed_out = timed_out
+        self.row_number = row_number # Estimated rows of each loop
+        self.actual_rows = actual_rows # Actual rows of each loop, an average rounded to an integer by Postgres
+        # Set by build_qep_tree from the children, the part of the node's time and cost that is its own
+        self.exclusive_time = None
+        self.estimated_exclusive_cost = None
         self.relation_name = relation_name
+        self.alias = alias
+        self.parent_relationship = parent_relationship # How the node feeds its parent, such as Outer or InitPlan
         self.group_key = group_key
         self.sort_method = sort_method
         self.sort_key = sort_key
@@ -25,6 +74,51 @@ class Node(object):
         self.recheck_condition = recheck_condition
         self.annotation = None
         self.children = []
+        # Set by index_steps from the position of the node in its step list
+        self.position = None # Position of the node in the step list
+        self.subtree_start = None # Position of the first step in the subtree of the node
+        self.relations = None # Relations scanned in the subtree of the node, by alias, which is its signature
+        # Set on the root node by build_qep_tree from the times Postgres reported for the plan, in ms
+        self.planning_time = None
+        self.execution_time = None
+        self.jit_time = None
+        self.settings = None # Planner settings that differ from their defaults, such as seq_page_cost
+        # Set by build_node when the plan was analyzed with BUFFERS, in blocks and ms over all loops,
+        # including the subtree of the node. I/O times are only reported with track_io_timing
+        self.shared_hit_blocks = None
+        self.shared_read_blocks = None
+        self.shared_written_blocks = None
+        self.local_hit_blocks = None
+        self.local_read_blocks = None
+        self.local_written_blocks = None
+        self.io_read_time = None
+        self.io_write_time = None
+        # Set when the plan was measured over repeated runs, the inclusive and exclusive times
+        # of each run in ms over the loops of one process. inclusive_time is then the median of the runs
+        self.run_times = None
+        self.exclusive_run_times = None
+        # Set by build_node when the plan was analyzed, how the node spills to disk, sort or hash, if it
+        # does, with the memory and disk it used in kB and the batches of hashes
+        self.spill = None
+        self.sort_space_used = None
+        self.hash_batches = None
+        self.original_hash_batches = None
+        self.peak_memory_usage = None
+        self.disk_usage = None
+        # Set by build_node, the number of processes the node runs in, whether it splits its work between
+        # the processes of a parallel subtree, the workers of Gather nodes and the time in ms of each worker
+        # over its loops, reported with VERBOSE
+        self.processes = 1
+        self.parallel_aware = False
+        self.workers_planned = None
+        self.workers_launched = None
+        self.worker_times = None
+
+    def get_operator_name(self):
+        """
+        Returns the operator of the node, such as HashAggregate for a hashed Aggregate
+        """
+        return getOperatorName(self.node_type, self.strategy)
 
     def add_child(self, child):
         """
@@ -48,12 +142,12 @@ class Node(object):
         """
         Prints out the tree structure from this node
         """
-        node_list = [self, None]
-        child_num_list = [1]
+        node_list = deque([self, None])
+        child_num_list = deque([1])
         output_string = ""
 
         while len(node_list) != 0:
-            node = node_list.pop(0)
+            node = node_list.popleft()
             
             # If branch has no children
             if node == 0: 
@@ -73,7 +167,7 @@ class Node(object):
                 output_string += "\n"
 
                 if len(child_num_list) != 0:
-                    child_num_list.pop(0)
+                    child_num_list.popleft()
                     
                 # If not the end of the tree; there are remaining nodes in the tree
                 if len(node_list) != 0: 
@@ -101,7 +195,7 @@ class Node(object):
             
             # If there is a different branch on the same level
             elif node_list[0] != None: 
-                child_num_list.pop(0) # Remove children count for the current branch
+                child_num_list.popleft() # Remove children count for the current branch
                 output_string += " | " # Print branch separator
 
         if enable_print:
@@ -119,15 +213,15 @@ class Node(object):
         # Go through the tree
         while len(node_list) != 0:
 
-            node = node_list.pop(0) # Remove this node from the step list
+            node = node_list.pop() # Remove the last node from the node list
             step_list.append(node) # Add this node to the step list
 
-            # Add the children of this node to the node list in reverse order
-            for child in node.children: 
-                node_list.insert(0, child)
+            # Add the children of this node to the node list, the last child is visited first
+            node_list.extend(node.children)
 
         # Reverse the step list
-        step_list = step_list[::-1]
+        step_list.reverse()
+        index_steps(step_list)
 
         if enable_print:
             for step in step_list:
@@ -140,63 +234,149 @@ def build_qep_tree(json_qep_data):
     """
     Takes QEP in json format as input and generates a tree structure for the QEP
     """
-    child_plans = queue.Queue() # List of Plans
-    parent_nodes = queue.Queue() # List of Nodes
-
-    plan = json_qep_data[0][0][0]['Plan'] # Get first Plan of the QEP
-
-    child_plans.put(plan)
-    parent_nodes.put(None)
-
-    # Get all Nodes for the QEP Tree
-    while not child_plans.empty(): 
-        cur_plan = child_plans.get() # Current json Plan
-        par_node = parent_nodes.get() # Parent Node
-  
-        # Set Node attributes
-        ## General Node Info
-        node_type = cur_plan['Node Type']
-        node_cost = cur_plan['Actual Total Time'] - cur_plan['Actual Startup Time']
-        row_number = cur_plan['Plan Rows']
-        relation_name = cur_plan['Relation Name'] if ('Relation Name' in cur_plan) else None
-        ## Groupings
-        group_key = cur_plan['Group Key'] if ('Group Key' in cur_plan) else None
-        ## Sorts
-        sort_method = cur_plan['Sort Method'] if ('Sort Method' in cur_plan) else None
-        sort_key = cur_plan['Sort Key'] if ('Sort Key' in cur_plan) else None
-        ## Joins
-        ### Index Join
-        index_name = cur_plan['Index Name'] if ('Index Name' in cur_plan) else None
-        index_condition = cur_plan['Index Cond'] if ('Index Cond' in cur_plan) else None
-        ### Hash Join
-        hash_condition = cur_plan['Hash Cond'] if ('Hash Cond' in cur_plan) else None
-        ### Merge Join
-        merge_condition = cur_plan['Merge Cond'] if ('Merge Cond' in cur_plan) else None
-        ## Filters
-        rows_filtered = cur_plan['Rows Removed by Filter'] if ('Rows Removed by Filter' in cur_plan) else None
-        ## Rechecks
-        recheck_condition = cur_plan['Recheck Cond'] if ('Recheck Cond' in cur_plan) else None
-
-        # Build the Node
-        cur_node = Node(node_type, node_cost, row_number, relation_name, 
-                        group_key, sort_method, sort_key, index_name, index_condition,
-                        hash_condition, merge_condition, rows_filtered, recheck_condition)
-
-        # Add the newly built Node as a child of its parent Node
-        if par_node != None:
-            par_node.add_child(cur_node)
-        # Otherwise set the new Node as the root Node
-        else:
-            root_node = cur_node
+    qep_data = json_qep_data[0][0][0]
+    plan = qep_data['Plan'] # Get first Plan of the QEP
+    # Set if the plan was cancelled for running too long, to the multiple of the QEP time it ran past
+    # or to 0 when there was no QEP time to compare with
+    timed_out = qep_data.get('Timeout Multiple', 0) if qep_data.get('Timed Out') is not None else None
+
+    root_node = build_node(plan, timed_out)
+    root_node.planning_time = qep_data.get('Planning Time')
+    root_node.execution_time = qep_data.get('Execution Time')
+    root_node.jit_time = qep_data.get('JIT', {}).get('Timing', {}).get('Total')
+    root_node.settings = qep_data.get('Settings', {})
+    # Nodes whose children are yet to be built, with their Plans and the number of processes the
+    # children run in, which is more than one below a Gather
+    node_stack = [(root_node, plan, 1)]
+
+    node_list = [root_node] # Nodes in the order they were built, parents before their children
+
+    # Get all Nodes for the QEP Tree in one pass
+    while node_stack:
+        par_node, par_plan, processes = node_stack.pop()
+        ## The workers of a Gather run its subtree, and so does the leader unless it is a single copy
+        if par_node.node_type in gather_node_types and par_node.workers_launched is not None:
+            processes = max(1, par_node.workers_launched + (0 if par_plan.get('Single Copy', False) else 1))
+
+        # Build the child Nodes in the order of their Plans
+        for cur_plan in par_plan.get('Plans', ()):
+            cur_node = build_node(cur_plan, timed_out, processes)
+            par_node.children.append(cur_node)
+            node_stack.append((cur_node, cur_plan, processes))
+            node_list.append(cur_node)
 
-        # Add futher Plans to the list
-        if 'Plans' in cur_plan:
-            for plan in cur_plan['Plans']:
-                child_plans.put(plan) # Put child Plans in the list
-                parent_nodes.put(cur_node) # Put the parent Nodes for each child Node into the list
+    # Take the time and cost of the children out of each node, children before their parents
+    for node in reversed(node_list):
+        node.estimated_exclusive_cost = max(0.0, node.estimated_cost - sum(child.estimated_cost for child in node.children))
+        if node.inclusive_time is not None:
+            node.exclusive_time = max(0.0, node.inclusive_time - sum(child.inclusive_time or 0.0 for child in node.children))
+        if node.run_times is not None:
+            node.exclusive_run_times = [max(0.0, run_time - sum(child.run_times[run] for child in node.children))
+                for run, run_time in enumerate(node.run_times)]
+            node.exclusive_time = statistics.median(node.exclusive_run_times)
 
     return root_node
 
+def build_node(cur_plan, timed_out=None, processes=1):
+    """
+    Takes a Plan in json format as input and builds its Node, without children. Below a Gather,
+    the node runs in processes processes at once
+    """
+    get = cur_plan.get
+
+    # Set Node attributes
+    ## General Node Info
+    node_type = cur_plan['Node Type']
+    parent_relationship = get('Parent Relationship')
+    strategy = get('Strategy')
+    ## Costs, the actual time when the plan was analyzed and otherwise the planner's estimate.
+    ## Actual Total Time and Actual Rows are averages over the loops of the node. Below a Gather the
+    ## loops of every process are counted together, so the time over all loops is split between the
+    ## processes to get the elapsed time of one of them. Actual Rows is rounded, so it is kept per loop
+    estimated_cost = cur_plan['Total Cost']
+    loops = get('Actual Loops', 1)
+    actual_total_time = get('Actual Total Time')
+    inclusive_time = actual_total_time * loops / processes if actual_total_time is not None else None
+    actual_rows = get('Actual Rows')
+    node_cost = inclusive_time if inclusive_time is not None else estimated_cost
+    row_number = cur_plan['Plan Rows']
+    relation_name = get('Relation Name')
+    alias = get('Alias', relation_name)
+    ## Groupings
+    group_key = get('Group Key')
+    ## Sorts
+    sort_method = get('Sort Method')
+    sort_key = get('Sort Key')
+    ## Joins
+    ### Index Join
+    index_name = get('Index Name')
+    index_condition = get('Index Cond')
+    ### Hash Join
+    hash_condition = get('Hash Cond')
+    ### Merge Join
+    merge_condition = get('Merge Cond')
+    ## Filters
+    rows_filtered = get('Rows Removed by Filter')
+    ## Rechecks
+    recheck_condition = get('Recheck Cond')
+
+    # Build the Node
+    node = Node(node_type, node_cost, row_number, relation_name,
+                group_key, sort_method, sort_key, index_name, index_condition,
+                hash_condition, merge_condition, rows_filtered, recheck_condition,
+                estimated_cost, inclusive_time, timed_out, alias, parent_relationship, loops, actual_rows, strategy)
+
+    ## Buffers, PostgreSQL 16 renamed the I/O times to tell shared and local blocks apart
+    node.shared_hit_blocks = get('Shared Hit Blocks')
+    node.shared_read_blocks = get('Shared Read Blocks')
+    node.shared_written_blocks = get('Shared Written Blocks')
+    node.local_hit_blocks = get('Local Hit Blocks')
+    node.local_read_blocks = get('Local Read Blocks')
+    node.local_written_blocks = get('Local Written Blocks')
+    node.io_read_time = get('I/O Read Time', get('Shared I/O Read Time'))
+    node.io_write_time = get('I/O Write Time', get('Shared I/O Write Time'))
+    ## Repeated runs, over all loops like Actual Total Time
+    run_times = get('Run Times')
+    node.run_times = [run_time / processes for run_time in run_times] if run_times is not None else None
+    ## Memory, hashed aggregates report their batches apart from the batches of Hash nodes
+    node.spill = getSpill(cur_plan)
+    node.sort_space_used = get('Sort Space Used')
+    node.hash_batches = get('Hash Batches', get('HashAgg Batches'))
+    node.original_hash_batches = get('Original Hash Batches')
+    node.peak_memory_usage = get('Peak Memory Usage')
+    node.disk_usage = get('Disk Usage')
+    ## Parallel workers
+    node.processes = processes
+    node.parallel_aware = get('Parallel Aware', False)
+    node.workers_planned = get('Workers Planned')
+    node.workers_launched = get('Workers Launched')
+    worker_times = [worker['Actual Total Time'] * worker.get('Actual Loops', 1) for worker in get('Workers', ())
+        if 'Actual Total Time' in worker]
+    node.worker_times = worker_times if len(worker_times) != 0 else None
+    return node
+
+def index_steps(step_list):
+    """
+    Precomputes the position and subtree data of every node in a step list in one pass.
+    Children come before their parents in the step list, so their subtrees are done first
+    """
+    for position, step in enumerate(step_list):
+        step.position = position
+
+        ## Subtree data from the children
+        subtree_start = position
+        for child in step.children:
+            subtree_start = min(subtree_start, child.subtree_start)
+        ## Merge the relations of all children at once, merging them one by one is quadratic for wide nodes
+        if len(step.children) == 1:
+            relations = step.children[0].relations
+        else:
+            relations = frozenset().union(*[child.relations for child in step.children])
+        if step.alias is not None and step.alias not in relations:
+            relations = relations | {step.alias}
+        step.subtree_start = subtree_start
+        step.relations = relations
+
 def build_initial_QEP_tree(qep):
     return build_qep_tree(qep).print_qep_steps(enable_print=False)
 
@@ -212,23 +392,29 @@ def build_noscan_AQPs_tree_list(no_scan_list):
         noscan_AQPs.append(build_qep_tree(aqp).print_qep_steps(enable_print=False))
     return noscan_AQPs
 
-def generate_qep_reasons(QEP, nojoin_AQPs, noscan_AQPs, log=False):
+def build_nooperator_AQPs_tree_list(no_operator_list):
+    nooperator_AQPs = []
+    for aqp in no_operator_list:
+        nooperator_AQPs.append(build_qep_tree(aqp).print_qep_steps(enable_print=False))
+    return nooperator_AQPs
+
+def generate_qep_reasons(QEP, nojoin_AQPs, noscan_AQPs, log=False, nooperator_AQPs=(),
+    misestimate_factor=default_misestimate_factor, confidence=default_confidence, parallel_AQPs=()):
     anno_list = []
     step_count = 1
-    join_count = 0
 
-    # Create joins list
-    joins_list = []
-    for step in QEP:
-        if "Join" in step.node_type:
-            joins_list.append(step)
-    nojoin_steplist = []
-    for AQP in nojoin_AQPs:
-        ajoins_list = []
-        for step in AQP:
-            if "Join" in step.node_type:
-                ajoins_list.append(step)
-        nojoin_steplist.append(ajoins_list)
+    # Page costs the planner used for the QEP, the root is the last step
+    settings = (QEP[-1].settings or {}) if len(QEP) != 0 else {}
+    page_costs = (float(settings.get('seq_page_cost', default_seqpage_cost)),
+        float(settings.get('random_page_cost', default_randompage_cost)))
+
+    # Index the joins and scans of each AQP by their signature, the relations they cover
+    nojoin_indexes = [index_by_relations(AQP, "Join") for AQP in nojoin_AQPs]
+    noscan_indexes = [index_by_relations(AQP, "Scan") for AQP in noscan_AQPs]
+    # Index the topmost node of each signature, where the operators of the plans are compared
+    qep_tops = index_top_by_relations(QEP) if len(nooperator_AQPs) != 0 or len(parallel_AQPs) != 0 else {}
+    nooperator_tops = [(index_top_by_relations(AQP), AQP) for AQP in nooperator_AQPs]
+    parallel_tops = [(index_top_by_relations(AQP), AQP) for values, AQP in parallel_AQPs]
     
     # Review each step in the QEP
     for step in QEP: 
@@ -255,72 +441,46 @@ def generate_qep_reasons(QEP, nojoin_AQPs, noscan_AQPs, log=False):
             else:
                 output_string += step.node_type + "\n"
 
-            ## Compare to other potential Joins
-            for ajoins_list in nojoin_steplist:
+            ## Compare to other potential Joins covering the same relations
+            for join_index in nojoin_indexes:
                 astep = None
+                if log: print("Finding AQP join with the same relations")
+                for ajoin in join_index.get(step.relations, ()):
+                    if ajoin.node_type == step.node_type: continue
+                    if "Hash" in ajoin.node_type and hash_join: continue
+                    if "Merge" in ajoin.node_type and merge_join: continue
+                    if "Nest" in ajoin.node_type and nestedloop_join: continue
+                    if "Partition" in ajoin.node_type and partwise_join: continue
+                    astep = ajoin
+                    if log: print("AQP join found")
+                    break
 
-                ### Check if the AQP has the same number of joins
-                if len(ajoins_list) != len(joins_list):
-                    continue
-                
-                ### Find AQP join with the same complete relations and join separation
-                if log: print("Finding AQP join with the same complete relations and join separation")
-                relations_QEP = find_common_relations(step, QEP)
-                AQP = nojoin_AQPs[nojoin_steplist.index(ajoins_list)]
-                for ajoin in ajoins_list:
-                    relations_AQP = find_common_relations(ajoin, AQP)
-                    if relations_AQP == relations_QEP and ajoin.node_type != step.node_type:
-                        astep = ajoin
-                        if log: print("AQP join found")
-                        break
-
-                ### Otherwise find AQP join with the same half relations and join separation
-                if astep == None:
-                    if log: print("Finding AQP join with the same half relations and join separation")
-                    relations_QEP = find_common_relations(step, QEP)
-                    AQP = nojoin_AQPs[nojoin_steplist.index(ajoins_list)]
-                    for ajoin in ajoins_list:
-                        relations_AQP = find_common_relations(ajoin, AQP)
-                        if relations_AQP[:2] == relations_QEP[:2] and ajoin.node_type != step.node_type:
-                            astep = ajoin
-                            if log: print("AQP join found")
-                            break
-
-                ### Otherwise find AQP join with the same relations
-                if astep == None:
-                    if log: print("Finding AQP join with the same relations")
-                    relations_QEP = find_common_relations(step, QEP)
-                    AQP = nojoin_AQPs[nojoin_steplist.index(ajoins_list)]
-                    for ajoin in ajoins_list:
-                        relations_AQP = find_common_relations(ajoin, AQP)
-                        if relations_AQP[0] == relations_QEP[0] and relations_AQP[2] == relations_QEP[2] and ajoin.node_type != step.node_type:
-                            astep = ajoin
-                            if log: print("AQP join found")
-                            break
-
-                ### Otherwise the AQP has a different structure
+                ### Otherwise the AQP joins these relations in the same way or not at all
                 if astep == None:
-                    #### Use the AQP join in the same position as QEP
-                    if log: print("Using AQP join in the same position as QEP")
-                    astep = ajoins_list[join_count]
-                    if "Hash" in astep.node_type and hash_join: continue
-                    if "Merge" in astep.node_type and merge_join: continue
-                    if "Nest" in astep.node_type and nestedloop_join: continue
-                    if "Partition" in astep.node_type and partwise_join: continue
-                    #### If AQP join is the same type as QEP join, skip this AQP
-                    if astep.node_type == step.node_type: 
-                        if log: print("AQP join not found")
-                        continue
+                    if log: print("AQP join not found")
+                    continue
 
                 ### Log
                 if log: print(f"AQP {astep.node_type} costs {astep.node_cost}")
 
                 ### Check if QEP step is faster than AQP step
-                if step.node_cost < astep.node_cost:
-                    cost_ratio = astep.node_cost / step.node_cost
-                    ratio_2dp = round(cost_ratio * 100) / 100
-                    output_string += f"         {step.node_type} is {ratio_2dp} times faster than {astep.node_type}.\n"
-                    step.set_annotation(f"{step.node_type} is {ratio_2dp} times faster than {astep.node_type}.")
+                comparison = None
+                if astep.timed_out is not None:
+                    comparison = f"{step.node_type} is used as {describe_timeout(astep, astep.node_type)}."
+                else:
+                    step_cost, astep_cost, estimated = compare_costs(step, astep)
+                    ## Over repeated runs, the join is only faster if the difference is significant
+                    runs = compare_runs(operator_run_costs(step), operator_run_costs(astep), confidence)
+                    if runs is not None and not runs[0]:
+                        comparison = f"{step.node_type} is not measurably faster than {astep.node_type}, {runs[1]}."
+                    elif step_cost < astep_cost and step_cost > 0:
+                        cost_ratio = astep_cost / step_cost
+                        ratio_2dp = round(cost_ratio * 100) / 100
+                        comparison = f"{step.node_type} is {describe_ratio(ratio_2dp, estimated)} than {astep.node_type}" +\
+                            (f", {runs[1]}." if runs is not None else ".")
+                if comparison is not None:
+                    output_string += f"         {comparison}\n"
+                    step.set_annotation(comparison)
                     if "Hash" in astep.node_type: hash_join = True
                     if "Merge" in astep.node_type: merge_join = True
                     if "Nest" in astep.node_type: nestedloop_join = True
@@ -335,9 +495,6 @@ def generate_qep_reasons(QEP, nojoin_AQPs, noscan_AQPs, log=False):
             ## Log
             if log: print("")
 
-            ## Increment join count for tracking
-            join_count += 1
-
         # Scan
         elif "Scan" in step.node_type:
             ## Track if faster scans have been compared already
@@ -359,11 +516,11 @@ def generate_qep_reasons(QEP, nojoin_AQPs, noscan_AQPs, log=False):
             else:
                 output_string += step.node_type + "\n"
             
-            ## Compare to other potential Scans
-            for AQP in noscan_AQPs:
+            ## Compare to other potential Scans of the same relation
+            for scan_index in noscan_indexes:
                 astep = None
-                for anode in AQP:
-                    if "Scan" in anode.node_type and anode.relation_name == step.relation_name and anode.node_type != step.node_type:
+                for anode in scan_index.get(step.relations, ()):
+                    if anode.node_type != step.node_type:
                         if "Bitmap" in anode.node_type and bitmap_scan: continue
                         if "Index Scan" in anode.node_type and index_scan: continue
                         if "Index Only Scan" in anode.node_type and indexonly_scan: continue
@@ -376,12 +533,30 @@ def generate_qep_reasons(QEP, nojoin_AQPs, noscan_AQPs, log=False):
                 if log: print(f"AQP {astep.node_type} costs {astep.node_cost}") if astep else print("No AQP scan node found")
 
                 ### Check if QEP step is faster than AQP step
-                if astep and step.node_cost < astep.node_cost and step.node_cost > 0:
-                    cost_ratio = astep.node_cost / step.node_cost
-                    ratio_2dp = round(cost_ratio * 100) / 100
-                    output_string += f"         {step.node_type} is used for Relation {step.relation_name} as it is {ratio_2dp} times faster than " +\
-                        f"{'Sequential Scan' if 'Seq' in astep.node_type else astep.node_type}.\n"
-                    step.set_annotation(f"{'Sequential Scan' if 'Seq' in astep.node_type else astep.node_type}.")
+                comparison = None
+                if astep and astep.timed_out is not None:
+                    comparison = f"{step.node_type} is used for Relation {step.relation_name} as " +\
+                        f"{describe_timeout(astep, 'Sequential Scan' if 'Seq' in astep.node_type else astep.node_type)}."
+                elif astep:
+                    step_cost, astep_cost, estimated = compare_costs(step, astep)
+                    ## Over repeated runs, the scan is only faster if the difference is significant
+                    runs = compare_runs(operator_run_costs(step), operator_run_costs(astep), confidence)
+                    if runs is not None and not runs[0]:
+                        comparison = f"{step.node_type} is used for Relation {step.relation_name} but it is not measurably " +\
+                            f"faster than {'Sequential Scan' if 'Seq' in astep.node_type else astep.node_type}, {runs[1]}."
+                    elif step_cost < astep_cost and step_cost > 0:
+                        cost_ratio = astep_cost / step_cost
+                        ratio_2dp = round(cost_ratio * 100) / 100
+                        comparison = f"{step.node_type} is used for Relation {step.relation_name} as it is {describe_ratio(ratio_2dp, estimated)} than " +\
+                            f"{'Sequential Scan' if 'Seq' in astep.node_type else astep.node_type}" +\
+                            (f", {runs[1]}." if runs is not None else ".")
+                        ## Explain the difference with the pages each scan read
+                        pages = describe_pages(step, astep, page_costs)
+                        if pages is not None:
+                            comparison += f" {pages}"
+                if comparison is not None:
+                    output_string += f"         {comparison}\n"
+                    step.set_annotation(comparison)
                     if "Bitmap" in astep.node_type: bitmap_scan = True
                     if "Index Scan" in astep.node_type: index_scan = True
                     if "Index Only Scan" in astep.node_type: indexonly_scan = True
@@ -397,38 +572,572 @@ def generate_qep_reasons(QEP, nojoin_AQPs, noscan_AQPs, log=False):
             ## Log
             if log: print("")
 
-        # Sort
-        elif "Sort" in step.node_type:
+        # Aggregation, sort and caching operators
+        elif step.get_operator_name() in explained_operators:
             output_string += step.node_type + "\n"
+            comparison = explain_operator(step, qep_tops, nooperator_tops, confidence)
+            if comparison is not None:
+                output_string += f"         {comparison}\n"
+                step.set_annotation(comparison)
+
+        # Gather, where a parallel subtree ends
+        elif step.node_type in gather_node_types:
+            output_string += step.node_type + "\n"
+            comparison = explain_parallel(step, QEP, qep_tops, parallel_tops)
+            if comparison is not None:
+                output_string += f"         {comparison}\n"
+                step.set_annotation(comparison)
 
         # Others
         else:
             output_string += step.node_type + "\n"
 
+        # Flag nodes whose row estimate was far off, after their last explanation
+        misestimate = describe_misestimate(step, misestimate_factor)
+        if misestimate is not None:
+            if output_string.count("\n") == 1:
+                output_string += f"         {misestimate}\n"
+                step.set_annotation(misestimate)
+            else:
+                output_string = output_string[:-1] + f" {misestimate}\n"
+                step.set_annotation(f"{step.annotation} {misestimate}")
+
         anno_list.append(output_string)
 
     return anno_list
 
-def find_common_relations(join, step_list):
-    # List containing 2 scan relations and the number of joins between them and the input join
-    relation_list = [None, 0, None, 0]
-    relation_num = 0
+def index_by_relations(step_list, kind):
+    """
+    Indexes the steps whose node type contains kind by their signature, the set of relations
+    scanned below them, so that the matching step of another plan is found in O(1)
+    """
+    index = {}
+    for step in step_list:
+        if kind in step.node_type and len(step.relations) != 0:
+            index.setdefault(step.relations, []).append(step)
+    return index
 
-    idx = step_list.index(join) - 1
+def index_top_by_relations(step_list):
+    """
+    Indexes the topmost step of each signature, the set of relations scanned below it.
+    Parents come after their children in the step list, so the last step of a signature is its top
+    """
+    index = {}
+    for step in step_list:
+        if len(step.relations) != 0:
+            index[step.relations] = step
+    return index
 
-    # Find scan relations in the children of the join node
-    while idx >= 0:
-        step = step_list[idx]
-        if "Join" in step.node_type:
-            relation_list[relation_num * 2 + 1] += 1
-        if "Scan" in step.node_type:
-            relation_list[relation_num * 2] = step.relation_name
-            relation_num += 1
-            if relation_num > 1:
-                break
-        idx -= 1
-        
-    return relation_list
+def explain_operator(step, qep_tops, nooperator_tops, confidence=default_confidence):
+    """
+    Compares the part of the QEP that produces the relations of an operator with the same part
+    of the AQPs where the operator was turned off, and describes the first one that is slower,
+    or measurably slower when the plans were measured over repeated runs
+    """
+    operator = step.get_operator_name()
+    top = qep_tops.get(step.relations)
+    if top is None:
+        return None
+    not_faster = None # Description of the first AQP the operator is not measurably faster than
+
+    for atops, AQP in nooperator_tops:
+        atop = atops.get(step.relations)
+        if atop is None:
+            continue
+        ## Skip AQPs that still use the operator for these relations
+        agroup = AQP[atop.subtree_start:atop.position + 1]
+        aoperators = [anode.get_operator_name() for anode in agroup]
+        if operator in aoperators:
+            continue
+        ## Aggregates are replaced by another strategy, which is named
+        replacement = None
+        if "Aggregate" in operator:
+            replacement = next((aoperator for aoperator in reversed(aoperators) if "Aggregate" in aoperator), None)
+
+        if atop.timed_out is not None:
+            if replacement is not None:
+                return f"{operator} is used as {describe_timeout(atop, replacement)}."
+            return f"{operator} is used as the plan without it {describe_cancelled(atop.timed_out)} and was cancelled."
+        cost, acost, estimated = compare_subtree_costs(top, atop)
+        runs = compare_runs(measured_runs(top.run_times), measured_runs(atop.run_times), confidence)
+        if runs is not None and not runs[0]:
+            if not_faster is None and replacement is not None:
+                not_faster = f"{operator} is not measurably faster than {replacement}, {runs[1]}."
+            elif not_faster is None:
+                not_faster = f"The plan is not measurably faster with {operator} than without it, {runs[1]}."
+            continue
+        if cost < acost and cost > 0:
+            ratio_2dp = round(acost / cost * 100) / 100
+            measured = f", {runs[1]}." if runs is not None else "."
+            if replacement is not None:
+                return f"{operator} is used as it is {describe_ratio(ratio_2dp, estimated)} than {replacement}{measured}"
+            return f"{operator} is used as the plan is {describe_ratio(ratio_2dp, estimated)} with it than without it{measured}"
+    return not_faster
+
+def explain_parallel(step, QEP, qep_tops, parallel_tops):
+    """
+    Describes the workers a Gather or Gather Merge node launched, how evenly its parallel subtree was
+    split between its processes, and how long the part of the plan over its relations takes with the
+    numbers of workers of the AQPs
+    """
+    sentences = []
+    ## Missing workers
+    if step.workers_launched is not None and step.workers_planned is not None:
+        if step.workers_launched < step.workers_planned:
+            sentences.append(f"Only {step.workers_launched} of the {step.workers_planned} planned workers were launched, " +\
+                "as max_parallel_workers or max_worker_processes ran out.")
+        else:
+            sentences.append(f"It launched all {step.workers_planned} planned workers.")
+
+    ## Imbalance, the top of the parallel subtree runs in every process
+    if len(step.children) != 0:
+        imbalance = describe_imbalance(step.children[0])
+        if imbalance is not None:
+            sentences.append(imbalance)
+
+    ## Speedup over the AQPs with other numbers of workers
+    top = qep_tops.get(step.relations)
+    if top is not None and len(parallel_tops) != 0:
+        speedup = describe_parallel_speedup(top, QEP, parallel_tops)
+        if speedup is not None:
+            sentences.append(speedup)
+    return " ".join(sentences) if len(sentences) != 0 else None
+
+def describe_imbalance(step):
+    """
+    Describes how evenly the time of a node was split between the workers and the leader, which takes
+    the time the workers did not, or None if the time of each worker was not reported
+    """
+    if step.worker_times is None or step.inclusive_time is None:
+        return None
+    process_times = list(step.worker_times)
+    ## The time of the node is the elapsed time of one process, the processes together took processes times it
+    leader_time = step.inclusive_time * step.processes - sum(step.worker_times)
+    if leader_time > 0:
+        process_times.append(leader_time)
+    average = sum(process_times) / len(process_times)
+    slowest = max(process_times)
+    if average > 0 and slowest / average > parallel_imbalance_factor:
+        return f"The slowest of its {len(process_times)} processes took {round(slowest / average, 2)} times the " +\
+            f"average ({round(slowest, 3)} ms against {round(average, 3)} ms), so the work was unevenly split."
+    return f"Its {len(process_times)} processes took {round(min(process_times), 3)} to {round(slowest, 3)} ms each, " +\
+        "so the work was evenly split."
+
+def count_workers(step_list, top):
+    """
+    Returns the workers launched, or planned when the plan was not analyzed, by the Gather nodes in
+    the subtree of a node
+    """
+    workers = 0
+    for step in step_list[top.subtree_start:top.position + 1]:
+        if step.node_type in gather_node_types:
+            workers += step.workers_launched if step.workers_launched is not None else (step.workers_planned or 0)
+    return workers
+
+def describe_parallel_speedup(top, QEP, parallel_tops):
+    """
+    Describes how long the part of the QEP over the relations of a parallel subtree takes with its
+    workers and with the workers of each AQP, and the speedup over running it without workers
+    """
+    workers = count_workers(QEP, top)
+    atops = [] # Top of the part of each AQP that ran, with its number of workers
+    cancelled = [] # Number of workers of each AQP that was cancelled, with its timeout multiple
+    for aindex, AQP in parallel_tops:
+        atop = aindex.get(top.relations)
+        if atop is None:
+            continue
+        if atop.timed_out is not None:
+            cancelled.append((count_workers(AQP, atop), atop.timed_out))
+        else:
+            atops.append((count_workers(AQP, atop), atop))
+
+    ## Times are only compared when every plan was analyzed
+    estimated = top.inclusive_time is None or any(atop.inclusive_time is None for aworkers, atop in atops)
+    cost = top.estimated_cost if estimated else top.inclusive_time
+    measurements = {} # Time or estimated cost of the part of the plan by number of workers
+    for aworkers, atop in atops:
+        if aworkers != workers:
+            measurements.setdefault(aworkers, atop.estimated_cost if estimated else atop.inclusive_time)
+    if len(measurements) == 0 and len(cancelled) == 0:
+        return None
+
+    unit = "" if estimated else " ms"
+    others = [f"{round(acost, 3)}{unit} with {aworkers} worker{'s' if aworkers != 1 else ''}"
+        for aworkers, acost in sorted(measurements.items())]
+    others.extend(f"a plan with {aworkers} worker{'s' if aworkers != 1 else ''} that {describe_cancelled(timed_out)} " +\
+        "and was cancelled" for aworkers, timed_out in cancelled)
+    description = f"This part of the plan {'is estimated to cost' if estimated else 'takes'} {round(cost, 3)}{unit} " +\
+        f"with {workers} workers, against {', '.join(others)}."
+    if 0 in measurements and cost > 0:
+        if measurements[0] >= cost:
+            description += f" Parallelism makes it {round(measurements[0] / cost, 2)} times faster than without workers."
+        elif measurements[0] > 0:
+            description += f" Parallelism makes it {round(cost / measurements[0], 2)} times slower than without workers."
+    if len(measurements) != 0:
+        fastest = min(measurements, key=measurements.get)
+        if measurements[fastest] < cost:
+            description += f" It is fastest with {fastest} workers."
+    return description
+
+def compare_subtree_costs(top, atop):
+    """
+    Returns the costs of the subtrees of a QEP node and an AQP node on the same basis, and whether
+    they are the planner's estimates
+    """
+    if top.inclusive_time is not None and atop.inclusive_time is not None:
+        runs, aruns = measured_runs(top.run_times), measured_runs(atop.run_times)
+        if runs is not None and aruns is not None:
+            return statistics.median(runs), statistics.median(aruns), False
+        return top.inclusive_time, atop.inclusive_time, False
+    return top.estimated_cost, atop.estimated_cost, True
+
+def compare_costs(step, astep):
+    """
+    Returns the costs of a QEP node and an AQP node on the same basis, and whether they are
+    the planner's estimates. Actual times are only compared when both plans were analyzed
+    """
+    if step.inclusive_time is not None and astep.inclusive_time is not None:
+        runs, aruns = operator_run_costs(step), operator_run_costs(astep)
+        if runs is not None and aruns is not None:
+            return statistics.median(runs), statistics.median(aruns), False
+        return operator_cost(step, False), operator_cost(astep, False), False
+    return operator_cost(step, True), operator_cost(astep, True), True
+
+def operator_cost(step, estimated):
+    """
+    Returns the time, or the estimated cost, of the operator of a node over all its loops.
+    A scan costs its whole subtree, such as the Bitmap Index Scan below a Bitmap Heap Scan.
+    Other operators cost their own part and that of the helper nodes they add below themselves,
+    such as the Hash of a Hash Join or the Sorts of a Merge Join, but not their inputs
+    """
+    if "Scan" in step.node_type:
+        return step.estimated_cost if estimated else step.inclusive_time
+    if estimated:
+        return step.estimated_exclusive_cost + sum(child.estimated_exclusive_cost
+            for child in step.children if child.node_type in operator_helper_types)
+    return step.exclusive_time + sum(child.exclusive_time
+        for child in step.children if child.node_type in operator_helper_types)
+
+def operator_run_costs(step):
+    """
+    Returns the time of the operator of a node in each run, as operator_cost, or None if the plan
+    was not measured over repeated runs
+    """
+    if measured_runs(step.run_times) is None:
+        return None
+    if "Scan" in step.node_type:
+        return step.run_times
+    helper_run_times = [child.exclusive_run_times for child in step.children if child.node_type in operator_helper_types]
+    return [sum(run_times) for run_times in zip(step.exclusive_run_times, *helper_run_times)]
+
+def measured_runs(run_times):
+    """
+    Returns the times of the runs of a node, or None if it was run fewer than 2 times
+    """
+    if run_times is None or len(run_times) < 2:
+        return None
+    return run_times
+
+def compare_runs(runs, aruns, confidence):
+    """
+    Returns whether a QEP node is faster than an AQP node over their runs with the given confidence,
+    by a one-sided Mann-Whitney U test, and a description of their medians. Returns None unless
+    both nodes were measured over repeated runs
+    """
+    if runs is None or aruns is None:
+        return None
+    significant = mann_whitney_p(runs, aruns) <= 1 - confidence
+    description = f"with medians of {round(statistics.median(runs), 3)} and {round(statistics.median(aruns), 3)} ms " +\
+        f"over {len(runs)} runs"
+    if significant:
+        description += f" at {round(confidence * 100)}% confidence"
+    return significant, description
+
+def mann_whitney_p(runs, aruns):
+    """
+    Returns the probability that runs would be at least this much faster than aruns if both came
+    from the same distribution, from the exact distribution of the Mann-Whitney U statistic.
+    Ties count as half, and are rounded against the QEP
+    """
+    slower_pairs = sum(1.0 if run > arun else 0.5 if run == arun else 0.0 for run in runs for arun in aruns)
+    counts = u_distribution(len(runs), len(aruns))
+    return sum(counts[:math.ceil(slower_pairs) + 1]) / sum(counts)
+
+@lru_cache(maxsize=None)
+def u_distribution(m, n):
+    """
+    Returns the number of orderings of m runs of one plan and n runs of another with each number of
+    pairs where the first plan is slower, built up one run at a time
+    """
+    # rows[j] holds the counts for the runs of the first plan so far and j runs of the other
+    rows = [[1] for _ in range(n + 1)]
+    for i in range(1, m + 1):
+        row = [[1]]
+        for j in range(1, n + 1):
+            # The slowest run is from the first plan, slower than all j runs of the other, or from the other
+            first = [0] * j + rows[j]
+            other = row[j - 1]
+            row.append([(first[u] if u < len(first) else 0) + (other[u] if u < len(other) else 0)
+                for u in range(i * j + 1)])
+        rows = row
+    return tuple(rows[n])
+
+def median_interval(run_times, confidence):
+    """
+    Returns a distribution-free confidence interval of the median of the times of the runs, from their
+    order statistics, and its confidence level. The narrowest interval whose level reaches confidence
+    is used, or the range of the times when there are too few runs to reach it
+    """
+    run_times = sorted(run_times)
+    n = len(run_times)
+    k, level = 1, 1 - 2 * 0.5 ** n
+    for candidate in range(2, (n + 1) // 2 + 1):
+        candidate_level = 1 - 2 * sum(math.comb(n, j) for j in range(candidate)) / 2 ** n
+        if candidate_level < confidence:
+            break
+        k, level = candidate, candidate_level
+    return run_times[k - 1], run_times[n - k], level
+
+def describe_runs(run_times, confidence):
+    """
+    Describes the median, range and confidence interval of the median of the times of a node's runs
+    """
+    low, high, level = median_interval(run_times, confidence)
+    return f"median of {len(run_times)} runs, ranging from {round(min(run_times), 3)} to " +\
+        f"{round(max(run_times), 3)} ms, {round(level * 100, 1)}% confidence interval of the median " +\
+        f"{round(low, 3)} to {round(high, 3)} ms"
+
+def build_parallel_AQPs_tree_list(parallel_list):
+    parallel_AQPs = []
+    for values, aqp in parallel_list:
+        parallel_AQPs.append((values, build_qep_tree(aqp).print_qep_steps(enable_print=False)))
+    return parallel_AQPs
+
+def build_memory_AQPs_tree_list(memory_list):
+    memory_AQPs = []
+    for memory, aqp in memory_list:
+        memory_AQPs.append((memory, build_qep_tree(aqp).print_qep_steps(enable_print=False)))
+    return memory_AQPs
+
+def generate_memory_sweep(QEP, memory_AQPs):
+    """
+    Describes each node of the QEP that spills to disk, with the smallest memory setting of the sweep
+    that keeps it in memory and how much faster the node and the whole plan are with it. Sorts only
+    use work_mem, hashes use work_mem times hash_mem_multiplier
+    """
+    # Nodes are matched by their operator and signature, in the order they appear in each plan
+    memory_indexes = [(memory, index_by_operator(AQP), AQP) for memory, AQP in memory_AQPs]
+    qep_index = index_by_operator(QEP)
+    sweep = []
+    for step in QEP:
+        if step.spill is None:
+            continue
+        key = (step.get_operator_name(), step.relations)
+        occurrence = qep_index[key].index(step)
+        description = f"Step {step.position + 1:<2}: {step.get_operator_name()} {describe_spill(step)}."
+
+        ## The memory the node has in each plan of the sweep, smallest first, with the node in the plan
+        ## or None when the planner replaced it with other operators
+        candidates = []
+        cancelled = False
+        for memory, index, AQP in memory_indexes:
+            node_memory = memory["work_mem"]
+            if step.spill == "hash":
+                node_memory *= memory.get("hash_mem_multiplier", 1.0)
+            ## Cancelled plans only have estimates, which say nothing about spilling
+            if AQP[-1].timed_out is not None or AQP[-1].inclusive_time is None:
+                cancelled = True
+                continue
+            asteps = index.get(key, [])
+            candidates.append((node_memory, memory, asteps[occurrence] if occurrence < len(asteps) else None, AQP))
+        candidates.sort(key=lambda candidate: candidate[0])
+
+        ## The sweep runs from the smallest memory to the largest
+        fitting = next((candidate for candidate in candidates if candidate[2] is None or candidate[2].spill is None), None)
+        if fitting is None and len(candidates) != 0:
+            description += f" It still spills with {getPlanName({}, candidates[-1][1])}."
+        elif fitting is None and cancelled:
+            description += " The plans with more memory were cancelled before it could be measured in them."
+        elif fitting is not None and fitting[2] is None:
+            _, memory, _, AQP = fitting
+            ## Operators over the same relations that the AQP has more of than the QEP
+            replacements = sorted(Counter(anode.get_operator_name() for anode in AQP if anode.relations == step.relations) -
+                Counter(node.get_operator_name() for node in QEP if node.relations == step.relations))
+            description += f" With {getPlanName({}, memory)} the planner no longer uses it"
+            if len(replacements) != 0:
+                description += f" and uses {', '.join(replacements)} instead"
+            speedup = describe_query_speedup(QEP, AQP)
+            if speedup is not None:
+                description += f", which makes the query {speedup}"
+            description += "."
+        elif fitting is not None:
+            _, memory, astep, AQP = fitting
+            if step.spill == "sort":
+                memory = {"work_mem": memory["work_mem"]}
+            description += f" It stays in memory with {getPlanName({}, memory)}"
+            node_time, anode_time = operator_cost(step, False), operator_cost(astep, False)
+            if anode_time > 0 and node_time > anode_time:
+                description += f", which makes it {round(node_time / anode_time, 2)} times faster"
+            else:
+                description += f", but it is not faster ({round(anode_time, 3)} ms against {round(node_time, 3)} ms)"
+            speedup = describe_query_speedup(QEP, AQP)
+            if speedup is not None:
+                description += f" and the query {speedup}"
+            description += "."
+        sweep.append(description)
+    return sweep
+
+def describe_query_speedup(QEP, AQP):
+    """
+    Describes how many times faster or slower an AQP ran than the QEP, or None if they took about as long
+    """
+    execution_time, aexecution_time = QEP[-1].execution_time, AQP[-1].execution_time
+    if not execution_time or not aexecution_time or round(execution_time / aexecution_time, 2) == 1:
+        return None
+    if execution_time >= aexecution_time:
+        return f"{round(execution_time / aexecution_time, 2)} times faster"
+    return f"{round(aexecution_time / execution_time, 2)} times slower"
+
+def index_by_operator(step_list):
+    """
+    Indexes the steps by their operator and signature, in the order of the step list
+    """
+    index = {}
+    for step in step_list:
+        index.setdefault((step.get_operator_name(), step.relations), []).append(step)
+    return index
+
+def describe_spill(step):
+    """
+    Describes how a node spills to disk
+    """
+    if step.spill == "sort":
+        return f"spills to disk with {step.sort_method}, using {step.sort_space_used} kB of disk"
+    description = f"spills into {step.hash_batches} batches"
+    if step.original_hash_batches is not None and step.original_hash_batches != step.hash_batches:
+        description += f" ({step.original_hash_batches} planned)"
+    if step.peak_memory_usage is not None:
+        description += f" with a peak memory of {step.peak_memory_usage} kB"
+    if step.disk_usage is not None:
+        description += f", using {step.disk_usage} kB of disk"
+    return description
+
+def generate_hot_nodes(QEP, count=default_hot_nodes, confidence=default_confidence):
+    """
+    Returns a description of the count nodes of the QEP that take the most time by themselves,
+    hottest first, or that have the highest estimated cost when the QEP was not analyzed.
+    Over repeated runs, the time is the median and its spread is described
+    """
+    estimated = QEP[-1].exclusive_time is None
+    self_cost = (lambda step: step.estimated_exclusive_cost) if estimated else (lambda step: step.exclusive_time)
+    total = sum(self_cost(step) for step in QEP)
+    hot_nodes = []
+    for step in sorted(QEP, key=self_cost, reverse=True)[:count]:
+        share = self_cost(step) / total * 100 if total > 0 else 0
+        if estimated:
+            hot_node = f"Step {step.position + 1:<2}: {step.node_type} has an estimated cost of " +\
+                f"{round(self_cost(step), 2)} by itself ({round(share, 1)}%), for {step.row_number} estimated rows"
+        else:
+            hot_node = f"Step {step.position + 1:<2}: {step.node_type} takes {round(self_cost(step), 3)} ms " +\
+                f"by itself ({round(share, 1)}%) over {step.loops} loops, {describe_rows(step)}"
+            if measured_runs(step.exclusive_run_times) is not None:
+                hot_node += f", {describe_runs(step.exclusive_run_times, confidence)}"
+        hot_nodes.append(hot_node)
+    return hot_nodes
+
+def describe_ratio(ratio_2dp, estimated):
+    """
+    Describes how much cheaper a QEP node is than an AQP node
+    """
+    if estimated:
+        return f"estimated to be {ratio_2dp} times cheaper"
+    return f"{ratio_2dp} times faster"
+
+def get_scan_pages(step):
+    """
+    Returns the pages a scan read and how many of them were read from disk rather than found in
+    shared buffers, or None if the plan was not analyzed with BUFFERS
+    """
+    if step.shared_hit_blocks is None:
+        return None
+    disk_pages = step.shared_read_blocks + (step.local_read_blocks or 0)
+    return step.shared_hit_blocks + (step.local_hit_blocks or 0) + disk_pages, disk_pages
+
+def describe_pages(step, astep, page_costs):
+    """
+    Describes the pages read by a QEP scan and an AQP scan, with the cost the planner gives to
+    each page, and whether the difference in time comes from reading pages or from CPU
+    """
+    pages = get_scan_pages(step)
+    apages = get_scan_pages(astep)
+    if pages is None or apages is None:
+        return None
+
+    seq_page_cost, random_page_cost = page_costs
+    def describe_scan(scan, scan_pages):
+        total_pages, disk_pages = scan_pages
+        page_cost, page_kind = (seq_page_cost, "sequential") if "Seq" in scan.node_type else (random_page_cost, "random")
+        return f"{total_pages} pages ({disk_pages} from disk) at {page_cost} per {page_kind} page"
+    description = f"It read {describe_scan(step, pages)}, against {describe_scan(astep, apages)} for " +\
+        f"{'Sequential Scan' if 'Seq' in astep.node_type else astep.node_type}"
+
+    # With track_io_timing the time spent reading tells I/O and CPU apart, otherwise the pages from disk do
+    time_saved = (astep.inclusive_time or 0) - (step.inclusive_time or 0)
+    if step.io_read_time is not None and astep.io_read_time is not None and time_saved > 0:
+        io_saved = astep.io_read_time - step.io_read_time
+        cause = "reading fewer pages" if io_saved >= time_saved / 2 else "less CPU work on the pages"
+        description += f", so most of the {round(time_saved, 2)} ms saved comes from {cause}."
+    elif pages[1] == 0 and apages[1] == 0:
+        description += ", all of them cached, so the difference is CPU work."
+    else:
+        description += "."
+    return description
+
+def describe_misestimate(step, misestimate_factor):
+    """
+    Describes how far the actual rows of a node were from the planner's estimate, or None if the
+    estimate was within misestimate_factor or the node was not run
+    """
+    if step.actual_rows is None or not step.loops:
+        return None
+    ## Rows are compared per loop. Postgres rounds the average rows of a loop, so a node that returned fewer
+    ## rows than it ran loops reports 0 and how far off the estimate was is unknown
+    if step.loops > 1 and step.actual_rows == 0:
+        return None
+    ratio = max(step.actual_rows, step.row_number) / max(min(step.actual_rows, step.row_number), 1)
+    if ratio <= misestimate_factor:
+        return None
+    comparison = f"{round(ratio, 1)} times {'more' if step.actual_rows > step.row_number else 'fewer'}."
+    if step.loops > 1:
+        return f"The planner estimated {step.row_number} rows per loop but {step.actual_rows} were returned " +\
+            f"on average over {step.loops} loops, {comparison}"
+    return f"The planner estimated {step.row_number} rows but {step.actual_rows} were returned, {comparison}"
+
+def describe_rows(step):
+    """
+    Describes the actual and estimated rows of an analyzed node, per loop when it ran more than once
+    """
+    if step.actual_rows is None:
+        return f"for {step.row_number} estimated rows"
+    if step.loops <= 1:
+        return f"for {step.actual_rows} rows ({step.row_number} estimated)"
+    if step.actual_rows == 0:
+        return f"for fewer than 1 row per loop on average ({step.row_number} estimated)"
+    return f"for {step.actual_rows} rows per loop on average ({step.row_number} estimated)"
+
+def describe_timeout(astep, astep_name):
+    """
+    Describes an AQP node whose plan was cancelled for running past its time budget
+    """
+    return f"the plan with {astep_name} {describe_cancelled(astep.timed_out)} and was cancelled"
+
+def describe_cancelled(timed_out):
+    """
+    Describes how long a cancelled plan ran, as a multiple of the QEP time when there was one
+    """
+    if timed_out:
+        return f"ran at least {timed_out} times longer than the QEP"
+    return "ran past its time budget"
 
 def print_annotations(anno_list):
     """
@@ -476,11 +1185,12 @@ order by
 limit 1;"""
 
 if __name__ == "__main__":
-    queryPlanGenerator = QueryPlanGenerator()
-    QEP = build_initial_QEP_tree(queryPlanGenerator.getAQP(query))
-    no_join_aqps_list = queryPlanGenerator.generateNoJoinAQPsList(query)
-    no_scan_aqps_list = queryPlanGenerator.generateNoScanAQPsList(query)
+    queryPlanGenerator = QueryPlanGenerator(parallel=True, timeout_multiple=10)
+    QEP = build_initial_QEP_tree(queryPlanGenerator.getQEP(query))
+    no_join_aqps_list, no_scan_aqps_list, no_operator_aqps_list = queryPlanGenerator.generateAllAQPsLists(query)
     nojoin_AQPs = build_nojoin_AQPs_tree_list(no_join_aqps_list)
     noscan_AQPs = build_noscan_AQPs_tree_list(no_scan_aqps_list)
-    anno_list = generate_qep_reasons(QEP, nojoin_AQPs, noscan_AQPs, log=False)
-    print_annotations(anno_list)
\ No newline at end of file
+    nooperator_AQPs = build_nooperator_AQPs_tree_list(no_operator_aqps_list)
+    anno_list = generate_qep_reasons(QEP, nojoin_AQPs, noscan_AQPs, log=False, nooperator_AQPs=nooperator_AQPs)
+    print_annotations(anno_list)
+    print("\n".join(generate_hot_nodes(QEP)))
\ No newline at end of file
@@ -0,0 +1,193 @@
+import asyncio
+import annotation
+import planparser
+import preprocessing
+
+# asyncpg runs all the plans of a query at the same time on one event loop when it is installed
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+class AsyncQueryPlanGenerator(preprocessing.QueryPlanGenerator):
+    """
+    Generates the QEP and the AQPs with asyncpg, so that each plan can be used as soon as it
+    arrives. At most max_workers plans run at the same time, each on its own connection
+    """
+    def __init__(self, max_workers=4, mode=preprocessing.analyze_mode, timeout_multiple=None, streaming=False,
+        query_timeout=None, profile=None) -> None:
+        if asyncpg is None:
+            raise ImportError("asyncpg is required for the asynchronous pipeline, pip install asyncpg")
+        super().__init__(parallel=True, max_workers=max_workers, mode=mode, timeout_multiple=timeout_multiple,
+            streaming=streaming, query_timeout=query_timeout, profile=profile)
+        self.pool = None
+        self.server_settings = None # Planner settings the server has
+
+    async def openPool(self):
+        """
+        Opens the pool of asyncpg connections the first time it is needed
+        """
+        if self.pool is None:
+            with self.profile.phase("connect"):
+                self.pool = await asyncpg.create_pool(min_size=1, max_size=self.max_workers, **self.connection.params)
+            with self.profile.phase("session settings"):
+                rows = await self.pool.fetch("SELECT name FROM pg_settings WHERE name = ANY($1::text[])",
+                    preprocessing.planner_settings)
+            self.server_settings = set(row['name'] for row in rows)
+        return self.pool
+
+    async def getAQPAsync(self, query, settings, analyze=True, timeout=None, values=None):
+        """
+        Generates the plan of a query with the planner settings in settings turned off or on,
+        the others are on, and the settings in values set to their values
+        """
+        settings = dict(dict.fromkeys(preprocessing.planner_settings, True), **settings)
+        values = values or {}
+        plan_name = preprocessing.getPlanName(settings, values)
+
+        # Every setting the server has is sent, the connections of the pool do not track their session settings
+        pool = await self.openPool()
+        statements = [f"SET LOCAL {name} TO {'on' if value else 'off'}"
+            for name, value in settings.items() if name in self.server_settings]
+        statements.extend(f"SET LOCAL {name} TO {value}" for name, value in values.items())
+        if timeout is not None:
+            statements.append(f"SET LOCAL statement_timeout TO {int(timeout)}")
+
+        try:
+            # The transaction is rolled back on errors and SET LOCAL ends with it
+            async with pool.acquire() as conn, conn.transaction():
+                server_version = conn.get_server_version()
+                explain = preprocessing.getExplain(query, analyze, server_version.major * 10000 + server_version.minor)
+                with self.profile.phase("explain", plan=plan_name, analyze=analyze, statements=len(statements) + 1):
+                    await conn.execute(";\n".join(statements))
+                    raw_plan = await conn.fetchval(explain)
+        except asyncpg.exceptions.QueryCanceledError:
+            if timeout is None:
+                raise
+            # The AQP ran past its time budget, keep its structure from the estimated plan
+            query_plan = await self.getAQPAsync(query, settings, analyze=False, values=values)
+            self.markTimedOut(query_plan, timeout)
+            return query_plan
+
+        # asyncpg returns json columns as text
+        with self.profile.phase("decode", plan=plan_name):
+            query_plan = planparser.decode_plan(raw_plan, streaming=self.streaming)
+        self.profile.addPlanTimes(plan_name, query_plan, analyze=analyze)
+        return query_plan
+
+    async def getQEPAsync(self, query):
+        """
+        Generates the QEP with the default planner settings. It is analyzed unless
+        only estimates are collected
+        """
+        # A cancelled QEP has no QEP time to be measured against, not even the one of the previous query
+        self.qep_time = None
+        analyze = self.mode != preprocessing.estimate_mode
+        with self.profile.phase("qep"):
+            query_plan = await self.getAQPAsync(query, {}, analyze, self.query_timeout if analyze else None)
+        self.setQEP(query, query_plan)
+        return query_plan
+
+    async def getParallelAQPsAsync(self, query):
+        """
+        Generates the AQPs with other numbers of parallel workers as generateParallelAQPsList does
+        """
+        if not self.hasParallelSubtrees(query):
+            return []
+        pool = await self.openPool()
+        session_workers = int(await pool.fetchval("SHOW max_parallel_workers_per_gather"))
+        analyze = self.mode == preprocessing.analyze_mode
+        timeout = self.getTimeBudget() if analyze else None
+        parallel_aqps = []
+        with self.profile.phase("parallel sweep"):
+            for values in self.selectParallelValues(session_workers):
+                with self.profile.phase("aqp", plan=preprocessing.getPlanName({}, values), analyze=analyze):
+                    parallel_aqps.append((values, await self.getAQPAsync(query, {}, analyze, timeout, values)))
+        return parallel_aqps
+
+    async def closeAsync(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+        self.close()
+
+async def streamAnnotations(query, queryPlanGenerator, update):
+    """
+    Generates the QEP, then all of its AQPs at the same time. update(qep, anno_list, done, total) is called
+    once the QEP arrives, with annotations that do not compare any AQP yet, and again as each AQP completes.
+    Returns the QEP and the final annotations, the same as those of the synchronous pipeline
+    """
+    profile = queryPlanGenerator.profile
+    qep = await queryPlanGenerator.getQEPAsync(query)
+    with profile.phase("build trees", plan="QEP"):
+        QEP = annotation.build_initial_QEP_tree(qep)
+    with profile.phase("annotate"):
+        anno_list = annotation.generate_qep_reasons(QEP, [], [])
+
+    join_settings, scan_settings, operator_settings = queryPlanGenerator.selectAllSettings(query)
+    settings_list = join_settings + scan_settings + operator_settings
+    # Position in settings_list where the scan and the operator AQPs start
+    scan_start = len(join_settings)
+    operator_start = scan_start + len(scan_settings)
+    update(qep, anno_list, 0, len(settings_list))
+
+    analyze = queryPlanGenerator.mode == preprocessing.analyze_mode
+    timeout = queryPlanGenerator.getTimeBudget() if analyze else None
+    aqps_list = [None] * len(settings_list)
+    aqp_steps = [None] * len(settings_list) # Step list of each AQP, built once when it arrives
+    parallel_AQPs = [] # AQPs with other numbers of parallel workers, generated after the others
+
+    async def generateAQP(i, analyze, timeout):
+        with profile.phase("aqp", plan=preprocessing.getPlanName(settings_list[i]), analyze=analyze):
+            aqp = await queryPlanGenerator.getAQPAsync(query, settings_list[i], analyze, timeout)
+        with profile.phase("build trees", plan="AQP"):
+            aqp_steps[i] = annotation.build_qep_tree(aqp).print_qep_steps(enable_print=False)
+        aqps_list[i] = aqp
+
+    def annotate():
+        # AQPs are compared in the order of their settings and duplicates are dropped as in the
+        # synchronous pipeline, whatever order they arrived in
+        AQPs = []
+        for start, end in ((0, scan_start), (scan_start, operator_start), (operator_start, len(aqps_list))):
+            AQPs.append([aqp_steps[start + i] for i in queryPlanGenerator.selectUniquePlans(query, aqps_list[start:end])])
+        nojoin_AQPs, noscan_AQPs, nooperator_AQPs = AQPs
+        with profile.phase("annotate"):
+            return annotation.generate_qep_reasons(QEP, nojoin_AQPs, noscan_AQPs, nooperator_AQPs=nooperator_AQPs,
+                parallel_AQPs=parallel_AQPs)
+
+    with profile.phase("aqps", count=len(settings_list)):
+        tasks = [asyncio.ensure_future(generateAQP(i, analyze, timeout)) for i in range(len(settings_list))]
+        for done, task in enumerate(asyncio.as_completed(tasks), 1):
+            await task
+            anno_list = annotate()
+            update(qep, anno_list, done, len(settings_list))
+
+        # Only analyze the AQP the planner estimated to be closest to the QEP
+        closest = queryPlanGenerator.selectClosestAQP(aqps_list)
+        if closest is not None:
+            await generateAQP(closest, True, queryPlanGenerator.getTimeBudget())
+            anno_list = annotate()
+            update(qep, anno_list, len(settings_list), len(settings_list))
+
+    # The workers of these AQPs would take the cores of the others, so they run last and one at a time
+    parallel_aqps_list = await queryPlanGenerator.getParallelAQPsAsync(query)
+    if len(parallel_aqps_list) != 0:
+        with profile.phase("build trees", plan="AQPs"):
+            parallel_AQPs.extend(annotation.build_parallel_AQPs_tree_list(parallel_aqps_list))
+        anno_list = annotate()
+        update(qep, anno_list, len(settings_list), len(settings_list))
+    return qep, anno_list
+
+def runStreamingPipeline(query, update, mode=preprocessing.analyze_mode, max_workers=4, timeout_multiple=None,
+    profile=None):
+    """
+    Runs streamAnnotations on a new event loop and returns the QEP and the final annotations
+    """
+    async def run():
+        queryPlanGenerator = AsyncQueryPlanGenerator(max_workers=max_workers, mode=mode,
+            timeout_multiple=timeout_multiple, profile=profile)
+        try:
+            return await streamAnnotations(query, queryPlanGenerator, update)
+        finally:
+            await queryPlanGenerator.closeAsync()
+    return asyncio.run(run())
@@ -0,0 +1,206 @@
+# Annotates a workload of queries without the GUI, one query per worker process
+# Run from the project folder: python batch.py queries/ --output annotations.jsonl
+
+import argparse
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from annotation import build_initial_QEP_tree, build_nojoin_AQPs_tree_list, build_noscan_AQPs_tree_list, generate_qep_reasons, \
+    build_nooperator_AQPs_tree_list, generate_hot_nodes, default_misestimate_factor, default_confidence, \
+    build_memory_AQPs_tree_list, generate_memory_sweep, build_parallel_AQPs_tree_list
+from plancache import PlanCache, tokenizeQuery
+from profiling import Profile
+from preprocessing import QueryPlanGenerator, QueryTimeout, analyze_mode, plan_modes
+
+default_timeout_multiple = 10
+
+# QueryPlanGenerator of the worker process, each worker has its own connection
+queryPlanGenerator = None
+# Factor past which row misestimates are flagged in the annotations of the worker process
+misestimateFactor = default_misestimate_factor
+# Confidence with which nodes measured over repeated runs must be faster to be described as faster
+confidence = default_confidence
+# Set to sweep work_mem for the nodes that spill to disk
+memorySweep = False
+# Time in ms all the plans of a query must run in, statements only get the time left of it
+queryTimeout = None
+
+def splitQueries(sql):
+    """
+    Splits SQL text on the semicolons that are not inside quotes or comments, dropping comments
+    and empty statements
+    """
+    queries = []
+    current = []
+    for kind, text in tokenizeQuery(sql):
+        if kind == "quoted":
+            current.append(text)
+            continue
+        if kind == "comment":
+            # Line comments end before their newline, so the comment can be replaced by a space
+            current.append(" ")
+            continue
+        statements = text.split(";")
+        for statement in statements[:-1]:
+            current.append(statement)
+            queries.append("".join(current))
+            current = []
+        current.append(statements[-1])
+    queries.append("".join(current))
+    return [query.strip() for query in queries if query.strip()]
+
+def readWorkload(paths):
+    """
+    Returns (query_id, query) pairs for every query in the files and folders of .sql files.
+    A file holding a single query is identified by its path, otherwise by its path and position
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, names in os.walk(path):
+                files.extend(os.path.join(folder, name) for name in names if name.endswith(".sql"))
+        else:
+            files.append(path)
+
+    workload = []
+    for file_path in sorted(files):
+        with open(file_path) as sql_file:
+            queries = splitQueries(sql_file.read())
+        if len(queries) == 1:
+            workload.append((file_path, queries[0]))
+        else:
+            workload.extend((f"{file_path}:{i + 1}", query) for i, query in enumerate(queries))
+    return workload
+
+def readCompleted(output_path):
+    """
+    Returns the ids of the queries already in the output, failed queries are run again
+    """
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path) as output_file:
+        for line in output_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The line of a run that was stopped while writing
+                continue
+            if record.get("status") != "error":
+                completed.add(record["id"])
+    return completed
+
+def initWorker(mode, timeout_multiple, query_timeout, use_cache, misestimate_factor=default_misestimate_factor,
+    repeats=1, warmup=0, cold=False, run_confidence=default_confidence, memory_sweep=False, replicas=None):
+    global queryPlanGenerator, misestimateFactor, confidence, memorySweep, queryTimeout
+    misestimateFactor = misestimate_factor
+    confidence = run_confidence
+    memorySweep = memory_sweep
+    queryTimeout = query_timeout
+    queryPlanGenerator = QueryPlanGenerator(mode=mode, timeout_multiple=timeout_multiple,
+        cache=PlanCache() if use_cache else None, repeats=repeats, warmup=warmup, cold=cold, replicas=replicas)
+
+def annotateQuery(query_id, query):
+    """
+    Annotates one query in a worker process and returns its JSONL record
+    """
+    start = time.perf_counter()
+    record = {"id": query_id}
+    profile = queryPlanGenerator.profile = Profile()
+    if queryTimeout is not None:
+        queryPlanGenerator.deadline = time.monotonic() + queryTimeout / 1000
+    try:
+        qep = queryPlanGenerator.getQEP(query)
+        top = qep[0][0][0]
+        record["execution_time"] = top.get('Execution Time')
+        if top.get('Timed Out') is not None:
+            # The QEP itself ran past the query timeout, there is nothing to compare the AQPs to
+            record["status"] = "timeout"
+        else:
+            no_join_aqps_list, no_scan_aqps_list, no_operator_aqps_list = queryPlanGenerator.generateAllAQPsLists(query)
+            parallel_aqps_list = queryPlanGenerator.generateParallelAQPsList(query)
+            with profile.phase("build trees"):
+                QEP = build_initial_QEP_tree(qep)
+                nojoin_AQPs = build_nojoin_AQPs_tree_list(no_join_aqps_list)
+                noscan_AQPs = build_noscan_AQPs_tree_list(no_scan_aqps_list)
+                nooperator_AQPs = build_nooperator_AQPs_tree_list(no_operator_aqps_list)
+                parallel_AQPs = build_parallel_AQPs_tree_list(parallel_aqps_list)
+            with profile.phase("annotate"):
+                record["annotations"] = generate_qep_reasons(QEP, nojoin_AQPs, noscan_AQPs, nooperator_AQPs=nooperator_AQPs,
+                    misestimate_factor=misestimateFactor, confidence=confidence, parallel_AQPs=parallel_AQPs)
+                record["hot_nodes"] = generate_hot_nodes(QEP, confidence=confidence)
+            if memorySweep:
+                memory_aqps_list = queryPlanGenerator.generateMemoryAQPsList(query, [step.spill for step in QEP])
+                with profile.phase("annotate"):
+                    record["memory_sweep"] = generate_memory_sweep(QEP, build_memory_AQPs_tree_list(memory_aqps_list))
+            record["status"] = "ok"
+    except QueryTimeout:
+        # The AQPs ran past the query timeout, the annotations would only compare some of them
+        record["status"] = "timeout"
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = "".join(traceback.format_exception_only(type(e), e)).strip()
+    finally:
+        queryPlanGenerator.deadline = None
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    record["profile"] = profile.summary()
+    record["plan_times"] = profile.plan_times
+    return record
+
+def main():
+    parser = argparse.ArgumentParser(description="Annotate the QEPs of a workload of queries")
+    parser.add_argument("paths", nargs="+", help=".sql files or folders of .sql files")
+    parser.add_argument("--output", required=True, help="JSONL file the annotations are appended to")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--mode", choices=plan_modes, default=analyze_mode)
+    parser.add_argument("--timeout-multiple", type=float, default=default_timeout_multiple,
+        help="Cancel AQPs that run this many times longer than the QEP")
+    parser.add_argument("--query-timeout", type=float,
+        help="Stop annotating a query once all of its plans together run longer than this many seconds")
+    parser.add_argument("--cache", action="store_true", help="Read and store plans in the plan cache")
+    parser.add_argument("--misestimate-factor", type=float, default=default_misestimate_factor,
+        help="Flag nodes whose actual rows are this many times more or fewer than estimated")
+    parser.add_argument("--repeats", type=int, default=1,
+        help="Run the QEP and the AQPs this many times in interleaved rounds, at least 3 to compare them")
+    parser.add_argument("--warmup", type=int, default=0, help="Run every plan this many times before measuring it")
+    parser.add_argument("--cold", action="store_true",
+        help="Evict the shared buffers of the database before each measured run, needs pg_buffercache on PostgreSQL 17+")
+    parser.add_argument("--confidence", type=float, default=default_confidence,
+        help="Only describe a plan as faster over repeated runs with this confidence")
+    parser.add_argument("--memory-sweep", action="store_true",
+        help="Analyze queries with sorts or hashes that spill to disk again at larger work_mem values")
+    parser.add_argument("--replica", action="append", dest="replicas", metavar="DSN",
+        help="DSN of an identical replica of the database, such as 'host=localhost port=5433 dbname=TPC-H', " +
+        "repeat for each replica. The QEPs run on the first one and the AQPs are spread across all of them")
+    args = parser.parse_args()
+    if args.mode != analyze_mode and (args.repeats > 1 or args.warmup > 0 or args.cold):
+        parser.error("--repeats, --warmup and --cold only apply to the analyze mode")
+
+    workload = readWorkload(args.paths)
+    completed = readCompleted(args.output)
+    pending = [(query_id, query) for query_id, query in workload if query_id not in completed]
+    print(f"{len(workload)} queries, {len(workload) - len(pending)} already annotated")
+
+    query_timeout = args.query_timeout * 1000 if args.query_timeout is not None else None
+    with open(args.output, "a+") as output_file:
+        # Finish a line cut short by an earlier run
+        if output_file.tell() > 0:
+            output_file.seek(output_file.tell() - 1)
+            if output_file.read(1) != "\n":
+                output_file.write("\n")
+
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=initWorker,
+            initargs=(args.mode, args.timeout_multiple, query_timeout, args.cache, args.misestimate_factor,
+                args.repeats, args.warmup, args.cold, args.confidence, args.memory_sweep, args.replicas)) as executor:
+            futures = [executor.submit(annotateQuery, query_id, query) for query_id, query in pending]
+            for done, future in enumerate(as_completed(futures), 1):
+                record = future.result()
+                # Each record is written as soon as its query finishes, so a stopped run can resume
+                output_file.write(json.dumps(record) + "\n")
+                output_file.flush()
+                print(f"[{done}/{len(pending)}] {record['id']}: {record['status']} in {record['seconds']}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+# Records the QEP and AQPs of the TPC-H queries, so the benchmarks can replay them without a database
+# Run from the project folder: python -m benchmarks.record
+
+import argparse
+import json
+import os
+import preprocessing
+from benchmarks.tpch import tpch_queries
+
+default_plans_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plans")
+default_timeout_multiple = 10
+
+def record_query(queryPlanGenerator, name, query):
+    """
+    Returns the QEP and the AQPs of a query, in the format read by the benchmarks
+    """
+    qep = queryPlanGenerator.getQEP(query)
+    no_join_aqps_list, no_scan_aqps_list, no_operator_aqps_list = queryPlanGenerator.generateAllAQPsLists(query)
+    return {"name": name, "query": query, "qep": qep, "no_join": no_join_aqps_list, "no_scan": no_scan_aqps_list,
+        "no_operator": no_operator_aqps_list}
+
+def main():
+    parser = argparse.ArgumentParser(description="Record TPC-H plans for the benchmarks")
+    parser.add_argument("--plans-dir", default=default_plans_dir)
+    parser.add_argument("--mode", default=preprocessing.analyze_mode, choices=preprocessing.plan_modes)
+    parser.add_argument("--timeout-multiple", type=float, default=default_timeout_multiple,
+        help="Cancel AQPs that run this many times longer than the QEP, they are recorded as estimated plans")
+    parser.add_argument("--queries", nargs="*", default=sorted(tpch_queries), help="Names of the queries to record")
+    args = parser.parse_args()
+
+    os.makedirs(args.plans_dir, exist_ok=True)
+    queryPlanGenerator = preprocessing.QueryPlanGenerator(parallel=True, mode=args.mode,
+        timeout_multiple=args.timeout_multiple)
+    try:
+        for name in args.queries:
+            recorded = record_query(queryPlanGenerator, name, tpch_queries[name])
+            with open(os.path.join(args.plans_dir, f"{name}.json"), "w") as plan_file:
+                json.dump(recorded, plan_file)
+            print(f"Recorded {name}")
+    finally:
+        queryPlanGenerator.close()
+
+if __name__ == "__main__":
+    main()
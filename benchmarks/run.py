@@ -0,0 +1,161 @@
+# Benchmarks the annotation pipeline on recorded TPC-H plans and synthetic plans, without a database
+# Run from the project folder: python -m benchmarks.run [--json results.json] [--compare baseline.json]
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+import annotation
+import planparser
+import planrender
+from benchmarks.record import default_plans_dir
+from benchmarks.synthetic import synthetic_workloads
+
+def load_recorded_workloads(plans_dir):
+    """
+    Returns the workloads recorded by benchmarks.record
+    """
+    workloads = []
+    for path in sorted(glob.glob(os.path.join(plans_dir, "*.json"))):
+        with open(path) as plan_file:
+            workloads.append(json.load(plan_file))
+    return workloads
+
+def load_interface():
+    """
+    Returns the interface module with charts disabled, or None if streamlit is not installed
+    """
+    try:
+        import interface
+    except ImportError:
+        return None
+    interface.st.graphviz_chart = lambda *args, **kwargs: None
+    return interface
+
+def prepare(workload):
+    """
+    Builds everything the stages need ahead of time, so each stage is timed on its own
+    """
+    prepared = dict(workload)
+    prepared["qep_text"] = json.dumps(workload["qep"][0][0])
+    prepared["qep_root"] = annotation.build_qep_tree(workload["qep"])
+    prepared["qep_steps"] = prepared["qep_root"].print_qep_steps(enable_print=False)
+    prepared["nojoin_AQPs"] = annotation.build_nojoin_AQPs_tree_list(workload["no_join"])
+    prepared["noscan_AQPs"] = annotation.build_noscan_AQPs_tree_list(workload["no_scan"])
+    # Plans recorded before the operator AQPs were added have none
+    prepared["no_operator"] = workload.get("no_operator", [])
+    prepared["nooperator_AQPs"] = annotation.build_nooperator_AQPs_tree_list(prepared["no_operator"])
+    prepared["anno_list"] = annotation.generate_qep_reasons(prepared["qep_steps"], prepared["nojoin_AQPs"],
+        prepared["noscan_AQPs"], nooperator_AQPs=prepared["nooperator_AQPs"])
+    return prepared
+
+def make_stages(interface):
+    """
+    Returns the stages of the pipeline by name, each taking a prepared workload
+    """
+    stages = {
+        "decode_plan": lambda w: planparser.decode_plan(w["qep_text"]),
+        "build_qep_tree": lambda w: annotation.build_qep_tree(w["qep"]),
+        "print_qep_steps": lambda w: w["qep_root"].print_qep_steps(enable_print=False),
+        "build_aqp_trees": lambda w: (annotation.build_nojoin_AQPs_tree_list(w["no_join"]),
+            annotation.build_noscan_AQPs_tree_list(w["no_scan"]), annotation.build_nooperator_AQPs_tree_list(w["no_operator"])),
+        "generate_qep_reasons": lambda w: annotation.generate_qep_reasons(w["qep_steps"], w["nojoin_AQPs"], w["noscan_AQPs"],
+            nooperator_AQPs=w["nooperator_AQPs"]),
+        "build_dot": lambda w: planrender.buildDot(w["qep_root"], w["anno_list"]),
+    }
+    if interface is not None:
+        stages["processQEPTree"] = lambda w: interface.processQEPTree(w["qep_root"], w["anno_list"])
+    return stages
+
+def measure(stage, workload, repeat):
+    """
+    Returns the latency of a stage over repeat runs, then its memory use in one traced run
+    """
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(repeat):
+            start = time.perf_counter()
+            stage(workload)
+            times.append((time.perf_counter() - start) * 1000)
+
+        # Memory is traced in a separate run, tracing slows the stage down
+        blocks_before = sys.getallocatedblocks()
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        result = stage(workload)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        retained_blocks = sys.getallocatedblocks() - blocks_before
+        del result
+
+    return {
+        "median_ms": statistics.median(times),
+        "min_ms": min(times),
+        "peak_kib": (peak - baseline) / 1024,
+        "retained_kib": (current - baseline) / 1024,
+        "retained_blocks": retained_blocks,
+    }
+
+def compare(results, baseline_path):
+    """
+    Prints the change in median latency and peak memory against an earlier run
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = {(r["workload"], r["stage"]): r for r in json.load(baseline_file)["results"]}
+    print(f"\nCompared to {baseline_path}")
+    for result in results:
+        old = baseline.get((result["workload"], result["stage"]))
+        if old is None or old["median_ms"] == 0:
+            continue
+        print(f"{result['workload']:<18} {result['stage']:<22} {result['median_ms'] / old['median_ms']:>6.2f}x time  " +
+            f"{result['peak_kib'] - old['peak_kib']:>+10.1f} KiB peak")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the annotation pipeline without a database")
+    parser.add_argument("--plans-dir", default=default_plans_dir, help="Folder of plans recorded by benchmarks.record")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", help="Only run workloads whose name contains this text")
+    parser.add_argument("--no-synthetic", action="store_true")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Compare with the results of an earlier run")
+    args = parser.parse_args()
+
+    workloads = load_recorded_workloads(args.plans_dir)
+    if len(workloads) == 0:
+        print(f"No recorded plans in {args.plans_dir}, run python -m benchmarks.record to record the TPC-H plans")
+    if not args.no_synthetic:
+        workloads += synthetic_workloads()
+    if args.only:
+        workloads = [workload for workload in workloads if args.only in workload["name"]]
+
+    interface = load_interface()
+    if interface is None:
+        print("streamlit is not installed, skipping processQEPTree")
+    stages = make_stages(interface)
+
+    results = []
+    print(f"{'workload':<18} {'stage':<22} {'nodes':>6} {'median ms':>10} {'min ms':>10} {'peak KiB':>10} {'kept KiB':>10}")
+    for workload in workloads:
+        prepared = prepare(workload)
+        for stage_name, stage in stages.items():
+            result = {"workload": workload["name"], "stage": stage_name, "nodes": len(prepared["qep_steps"])}
+            result.update(measure(stage, prepared, args.repeat))
+            results.append(result)
+            print(f"{result['workload']:<18} {stage_name:<22} {result['nodes']:>6} {result['median_ms']:>10.3f} " +
+                f"{result['min_ms']:>10.3f} {result['peak_kib']:>10.1f} {result['retained_kib']:>10.1f}")
+
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump({"python": platform.python_version(), "repeat": args.repeat, "results": results}, results_file, indent=1)
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
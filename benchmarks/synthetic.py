@@ -0,0 +1,113 @@
+# Synthetic plans in the format of EXPLAIN (ANALYZE, FORMAT JSON), for plans larger than TPC-H produces
+
+import copy
+
+def plan_node(node_type, own_time, rows, children=(), relation_name=None, **fields):
+    """
+    Returns a Plan whose times and costs include those of its children
+    """
+    total_time = own_time + sum(child["Actual Total Time"] for child in children)
+    plan = {
+        "Node Type": node_type,
+        "Startup Cost": 0.0,
+        "Total Cost": total_time * 10,
+        "Plan Rows": rows,
+        "Plan Width": 16,
+        "Actual Startup Time": 0.01,
+        "Actual Total Time": total_time,
+        "Actual Rows": rows,
+        "Actual Loops": 1,
+    }
+    if relation_name is not None:
+        plan["Relation Name"] = relation_name
+        plan["Alias"] = relation_name
+    plan.update(fields)
+    if children:
+        plan["Plans"] = list(children)
+    return plan
+
+def scan_node(relation_name, number):
+    """
+    Returns a Seq Scan or an Index Scan, alternating with number
+    """
+    if number % 2 == 0:
+        return plan_node("Seq Scan", 2.0, 1000, relation_name=relation_name, Filter="(x > 0)")
+    return plan_node("Index Scan", 0.5, 10, relation_name=relation_name,
+        **{"Index Name": f"{relation_name}_pkey", "Index Cond": "(id = 1)"})
+
+def wrap_plan(plan):
+    """
+    Wraps a Plan like the rows returned by the EXPLAIN
+    """
+    return [[[{"Plan": plan, "Planning Time": 1.0, "Execution Time": plan["Actual Total Time"]}]]]
+
+def deep_plan(depth):
+    """
+    Left-deep plan of depth Hash Joins
+    """
+    plan = scan_node("t0", 0)
+    for number in range(1, depth + 1):
+        hash_node = plan_node("Hash", 0.1, 1000, [scan_node(f"t{number}", number)])
+        plan = plan_node("Hash Join", 1.0, 1000, [plan, hash_node], **{"Hash Cond": f"(t{number}.id = t0.id)"})
+    return wrap_plan(plan_node("Aggregate", 0.5, 1, [plan], Strategy="Plain"))
+
+def wide_plan(width):
+    """
+    Plan of a UNION ALL of width scans
+    """
+    scans = [scan_node(f"u{number}", number) for number in range(width)]
+    append_node = plan_node("Append", 0.1, 1000 * width, scans)
+    return wrap_plan(plan_node("Aggregate", 0.5, 1, [append_node], Strategy="Plain"))
+
+def partitioned_plan(partitions):
+    """
+    Plan of a join between a table with partitions and another table
+    """
+    scans = [scan_node(f"lineitem_p{number}", number) for number in range(partitions)]
+    append_node = plan_node("Append", 0.1, 1000 * partitions, scans)
+    hash_node = plan_node("Hash", 0.1, 1000, [scan_node("orders", 0)])
+    join_node = plan_node("Hash Join", 5.0, 1000, [append_node, hash_node], **{"Hash Cond": "(l_orderkey = o_orderkey)"})
+    return wrap_plan(plan_node("Sort", 1.0, 1000, [join_node], **{"Sort Key": ["o_orderdate"], "Sort Method": "quicksort"}))
+
+def make_variant(query_plan, replacements, slowdown):
+    """
+    Returns a copy of a plan with node types replaced, and those nodes slowed down
+    """
+    variant = copy.deepcopy(query_plan)
+    stack = [variant[0][0][0]["Plan"]]
+    while stack:
+        plan = stack.pop()
+        if plan["Node Type"] in replacements:
+            plan["Node Type"] = replacements[plan["Node Type"]]
+            plan["Actual Total Time"] *= slowdown
+            plan["Total Cost"] *= slowdown
+        stack.extend(plan.get("Plans", []))
+    return variant
+
+def synthetic_workload(name, qep):
+    """
+    Returns a plan with its AQPs, in the format recorded by benchmarks.record
+    """
+    return {
+        "name": name,
+        "query": None,
+        "qep": qep,
+        "no_join": [make_variant(qep, {"Hash Join": "Merge Join"}, 1.5),
+            make_variant(qep, {"Hash Join": "Nested Loop"}, 3.0)],
+        "no_scan": [make_variant(qep, {"Index Scan": "Bitmap Heap Scan"}, 1.2),
+            make_variant(qep, {"Index Scan": "Seq Scan"}, 4.0)],
+        "no_operator": [make_variant(qep, {"Sort": "Incremental Sort"}, 2.0)],
+    }
+
+def synthetic_workloads(deep_sizes=(50, 200), wide_sizes=(100, 1000), partition_sizes=(1000, 5000)):
+    """
+    Returns deep, wide and partitioned workloads of each size
+    """
+    workloads = []
+    for depth in deep_sizes:
+        workloads.append(synthetic_workload(f"deep_{depth}", deep_plan(depth)))
+    for width in wide_sizes:
+        workloads.append(synthetic_workload(f"wide_{width}", wide_plan(width)))
+    for partitions in partition_sizes:
+        workloads.append(synthetic_workload(f"partitions_{partitions}", partitioned_plan(partitions)))
+    return workloads
@@ -1,78 +1,191 @@
 import annotation
+import asyncpipeline
+import math
 import streamlit as st
-import queue
-import graphviz
 import preprocessing
+import plancache
+import planrender
+import profiling
+import json
 
-#generate annotation with comparisons made to main QEP with 
+# Number of AQPs generated at the same time, each on its own connection
+aqp_workers = 8
+# AQPs running this many times longer than the QEP are cancelled
+aqp_timeout_multiple = 10
+# DSNs of identical replicas of the database, such as "host=localhost port=5433 dbname=TPC-H user=postgres",
+# the AQPs are spread across them. The first one runs the QEP
+replica_dsns = []
+
+# Query results are shown page by page, up to max_result_rows rows
+result_page_size = 100
+max_result_rows = 10000
+
+# Plans and annotations are kept on disk across restarts
+plan_cache = plancache.PlanCache()
+# Changed whenever the annotations change, so that older cached annotations are not shown
+annotation_version = 4
+
+#generate json result of QEP and annotation with comparisons made to main QEP with
 # AQPs without scan conditions and AQPs without join conditions
-@st.cache
-def queryProcessing(code):
-    queryPlanGenerator = preprocessing.QueryPlanGenerator()
-    json = queryPlanGenerator.getAQP(code)
-    QEP = annotation.build_initial_QEP_tree(json)
-    no_join_aqps_list = queryPlanGenerator.generateNoJoinAQPsList(code)
-    no_scan_aqps_list = queryPlanGenerator.generateNoScanAQPsList(code)
-    nojoin_AQPs = annotation.build_nojoin_AQPs_tree_list(no_join_aqps_list)
-    noscan_AQPs = annotation.build_noscan_AQPs_tree_list(no_scan_aqps_list)
-    anno_list = annotation.generate_qep_reasons(QEP, nojoin_AQPs, noscan_AQPs, log=False)
-
-    return anno_list
-
-#generate result of query and json result of QEP
-def getresultMain(query):
-    plans=[]
-    connection = preprocessing.DBConnection()
+#the QEP is collected once and shared by the annotation and the QEP tree
+#the time of each phase is recorded in profile when one is given
+#with repeats, the QEP and the AQPs are run that many times after warmup runs, from cold buffers if cold is set
+def queryProcessing(code, mode=preprocessing.analyze_mode, profile=None, repeats=1, warmup=0, cold=False):
+    queryPlanGenerator = preprocessing.QueryPlanGenerator(parallel=True, max_workers=aqp_workers, mode=mode,
+        timeout_multiple=aqp_timeout_multiple, cache=plan_cache, profile=profile, repeats=repeats, warmup=warmup, cold=cold,
+        replicas=replica_dsns or None)
+    profile = queryPlanGenerator.profile
+    try:
+        settings = dict(mode=mode, timeout_multiple=aqp_timeout_multiple, version=annotation_version,
+            repeats=repeats, warmup=warmup, cold=cold)
+        stats_version = queryPlanGenerator.getStatsVersion()
+        with profile.phase("cache lookup", plan="annotations"):
+            processed = plan_cache.get("annotations", code, settings, stats_version)
+        if processed is not None:
+            return processed
+
+        json = queryPlanGenerator.getQEP(code)
+        no_join_aqps_list, no_scan_aqps_list, no_operator_aqps_list = queryPlanGenerator.generateAllAQPsLists(code)
+        parallel_aqps_list = queryPlanGenerator.generateParallelAQPsList(code)
+    finally:
+        queryPlanGenerator.close()
+    #the QEP tree is built once the AQPs are measured, which adds the run times of the QEP
+    with profile.phase("build trees", plan="QEP"):
+        QEP = annotation.build_initial_QEP_tree(json)
+    with profile.phase("build trees", plan="AQPs"):
+        nojoin_AQPs = annotation.build_nojoin_AQPs_tree_list(no_join_aqps_list)
+        noscan_AQPs = annotation.build_noscan_AQPs_tree_list(no_scan_aqps_list)
+        nooperator_AQPs = annotation.build_nooperator_AQPs_tree_list(no_operator_aqps_list)
+        parallel_AQPs = annotation.build_parallel_AQPs_tree_list(parallel_aqps_list)
+    with profile.phase("annotate"):
+        anno_list = annotation.generate_qep_reasons(QEP, nojoin_AQPs, noscan_AQPs, log=False, nooperator_AQPs=nooperator_AQPs,
+            parallel_AQPs=parallel_AQPs)
+    processed = [json, anno_list]
+    with profile.phase("cache store", plan="annotations"):
+        plan_cache.put("annotations", code, settings, stats_version, processed)
+
+    return processed
+
+#generate the same result as queryProcessing with the asynchronous pipeline, the QEP tree is shown
+#as soon as the QEP arrives and its annotations are filled in as each AQP completes
+def streamQueryProcessing(code, mode, profile):
+    queryPlanGenerator = preprocessing.QueryPlanGenerator(cache=plan_cache, profile=profile)
+    try:
+        settings = dict(mode=mode, timeout_multiple=aqp_timeout_multiple, version=annotation_version)
+        stats_version = queryPlanGenerator.getStatsVersion()
+        with profile.phase("cache lookup", plan="annotations"):
+            processed = plan_cache.get("annotations", code, settings, stats_version)
+    finally:
+        queryPlanGenerator.close()
+    if processed is not None:
+        return processed
+
+    progress = st.empty()
+    tree_area = st.empty()
+    qep_root_nodes = []
+    def update(json, anno_list, done, total):
+        progress.write(f"Compared the QEP with {done} of {total} alternative plans")
+        if len(qep_root_nodes) == 0:
+            qep_root_nodes.append(annotation.build_qep_tree(json))
+        renderQEPTree(qep_root_nodes[0], anno_list, tree_area)
+
+    json, anno_list = asyncpipeline.runStreamingPipeline(code, update, mode, aqp_workers, aqp_timeout_multiple, profile)
+    #the finished page is displayed below as usual
+    progress.empty()
+    tree_area.empty()
+    processed = [json, anno_list]
+    with profile.phase("cache store", plan="annotations"):
+        plan_cache.put("annotations", code, settings, stats_version, processed)
+    return processed
+
+#generate QEP tree and annotation once for each query and measurement, later reruns of the page reuse them
+#returns the QEP tree, the annotations, the profile of processing the query and the fingerprint of the QEP
+#measured runs, repeated, after warm-up runs or from cold buffers, are interleaved one at a time and replicas
+#are only spread across by the synchronous pipeline, so neither uses the asynchronous pipeline
+def getProcessedQuery(code, mode, repeats=1, warmup=0, cold=False):
+    key = (code, mode, repeats, warmup, cold)
+    if st.session_state.get('processed_key') != key:
+        profile = profiling.Profile()
+        measured = mode == preprocessing.analyze_mode and (repeats > 1 or warmup > 0 or cold)
+        if asyncpipeline.asyncpg is not None and not measured and not replica_dsns:
+            json, anno_list = streamQueryProcessing(code, mode, profile)
+        else:
+            json, anno_list = queryProcessing(code, mode, profile, repeats, warmup, cold)
+        with profile.phase("build trees", plan="display"):
+            qep_root_node = annotation.build_qep_tree(json)
+        st.session_state['processed'] = (qep_root_node, anno_list, profile, preprocessing.getPlanFingerprint(json))
+        st.session_state['processed_key'] = key
+    return st.session_state['processed']
+
+#generate number of rows of query result, counted once for each query
+def getResultRowCount(query):
+    if st.session_state.get('row_count_key') != query:
+        queryPlanGenerator = preprocessing.QueryPlanGenerator()
+        try:
+            st.session_state['row_count'] = queryPlanGenerator.getQueryRowCount(query)
+        finally:
+            queryPlanGenerator.close()
+        st.session_state['row_count_key'] = query
+    return st.session_state['row_count']
+
+#generate one page of result of query, only run when the result is displayed
+def getresultMain(query, page=0):
     queryPlanGenerator = preprocessing.QueryPlanGenerator()
-    plans.append(connection.execute(query))
-    plans.append(queryPlanGenerator.getAQP(query))
-    connection.close()
-    return plans
-
-#display QEP tree with relevant annotations
-def processQEPTree(json , anno_list):
-    graph = graphviz.Digraph()
-    graph.attr(rankdir='BT' , bgcolor='lightblue' , margin='0.0 , 0.0')
-    graph.attr('node', shape='rect')
-
-    qep_root_node = annotation.build_qep_tree(json)
-    step_list = qep_root_node.print_qep_steps()
-
-    q = queue.Queue()
-    q.put(qep_root_node)
-    
-    parent=None
-    while not q.empty():
-        cur_node = q.get()
-        labelling = cur_node.node_type + "\n"
-        if(cur_node.relation_name is not None):
-            labelling+=str(cur_node.relation_name)
-        graph.node(name=str(cur_node) , label=labelling)
-        index = step_list.index(cur_node)
-        
-        #getting annotation and linking to relevant nodes
-        string = getAnnotation(index , anno_list)
-        if(string is not None):
-            graph.node(name=str(string) , label=string, color='red' )
-            graph.edge(str(string) , str(cur_node) , color='red')
-
-        print(cur_node.node_type)
-        if(parent!=None):
-            graph.edge(str(cur_node) , parent , dir='none')
-
-        for node in cur_node.children:
-            parent = str(cur_node)
-            q.put(node)
-    
-    st.graphviz_chart(graph , use_container_width=True)
-
-#find index node in step_list , which will then be used by anno_list 
-def getAnnotation(index , anno_list):
-    val=anno_list[index].split("\n")
-    if(len(val)==3):
-        return val[1]
-    return None
-    
+    try:
+        result = queryPlanGenerator.getQueryResultPage(query, page, result_page_size)
+    finally:
+        queryPlanGenerator.close()
+    return result
+
+#analyze the query again at larger work_mem values when its sorts or hashes spill to disk, once for each query
+def getMemorySweep(code, qep_root_node):
+    if st.session_state.get('memory_sweep_key') != code:
+        queryPlanGenerator = preprocessing.QueryPlanGenerator(timeout_multiple=aqp_timeout_multiple)
+        #the sweep plans are cancelled past a multiple of the time of the QEP that was already run
+        queryPlanGenerator.qep_time = qep_root_node.execution_time
+        try:
+            QEP = qep_root_node.print_qep_steps(enable_print=False)
+            memory_aqps_list = queryPlanGenerator.generateMemoryAQPsList(code, [step.spill for step in QEP])
+        finally:
+            queryPlanGenerator.close()
+        st.session_state['memory_sweep'] = annotation.generate_memory_sweep(QEP,
+            annotation.build_memory_AQPs_tree_list(memory_aqps_list))
+        st.session_state['memory_sweep_key'] = code
+    return st.session_state['memory_sweep']
+
+#display QEP tree with relevant annotations, the time taken is recorded in profile when one is given
+#the DOT source is cached by the fingerprint of the plan, collapsed parts of large plans can be expanded
+def processQEPTree(qep_root_node , anno_list, profile=None, fingerprint=None):
+    expanded = frozenset(st.session_state.get('expanded_nodes', []))
+    if profile is not None:
+        #only the latest rendering is kept, the tree is rendered again on every rerun of the page
+        profile.reset("render")
+        with profile.phase("render"):
+            summaries = renderQEPTree(qep_root_node, anno_list, st, fingerprint, expanded)
+    else:
+        summaries = renderQEPTree(qep_root_node, anno_list, st, fingerprint, expanded)
+
+    if len(summaries) != 0 or len(expanded) != 0:
+        labels = dict(st.session_state.get('summary_labels', {}), **summaries)
+        st.session_state['summary_labels'] = labels
+        st.multiselect("Expand collapsed nodes:" , options=sorted(set(summaries) | expanded) ,
+            format_func=lambda summary_id: labels.get(summary_id, summary_id) , key='expanded_nodes')
+
+#the tree is drawn in container, a placeholder when it is redrawn as annotations arrive
+#returns the ids and labels of the collapsed summary nodes
+def renderQEPTree(qep_root_node , anno_list, container=st, fingerprint=None, expanded=frozenset()):
+    dot_source, summaries = planrender.getDot(qep_root_node, anno_list, fingerprint, expanded)
+    container.graphviz_chart(dot_source , use_container_width=True)
+    return summaries
+
+#display the time spent in each phase and the times reported by Postgres for each plan
+def displayProfile(qep_root_node, profile):
+    st.write(f"Postgres planning time: {qep_root_node.planning_time} ms, execution time: " +
+        f"{qep_root_node.execution_time} ms, JIT time: {qep_root_node.jit_time} ms")
+    st.dataframe(profile.summary())
+    st.dataframe(profile.plan_times)
+    st.download_button("Download trace", json.dumps(profile.toTrace()), file_name="query_profile.json",
+        mime="application/json")
 
 def callback():
     # change state value
@@ -88,14 +201,30 @@ def running():
 
     with st.form(key="query field"):
         code = st.text_area("Enter Query:" , height=400 )
+        #analyze runs every plan, estimate only uses the planner's costs,
+        #hybrid only runs the QEP and the closest alternative plan
+        mode = st.radio("Plan collection:" , preprocessing.plan_modes , horizontal=True)
+        #in analyze mode, every plan can be run several times so that only significant differences are described
+        repeats = st.number_input("Runs of each plan:" , min_value=1 , max_value=50 , value=1 ,
+            help="Only used in analyze mode")
+        warmup = st.number_input("Warm-up runs of each plan:" , min_value=0 , max_value=10 , value=0 ,
+            help="Only used in analyze mode")
+        cold = st.checkbox("Evict shared buffers before each run (PostgreSQL 17+ with pg_buffercache)" ,
+            help="Only used in analyze mode")
         submit_code = st.form_submit_button("Execute" , on_click=callback)
 
     if submit_code or st.session_state['btn_clicked']:
         
-        anno_list= queryProcessing(code)
-        val = getresultMain(code)
-        st.write("Query result:" )
-        st.write(val[0])
+        qep_root_node, anno_list, profile, fingerprint = getProcessedQuery(code , mode , repeats , warmup , cold)
+
+        if st.checkbox('Display Query Result'):
+            row_count = getResultRowCount(code)
+            page_count = max(1, math.ceil(min(row_count, max_result_rows) / result_page_size))
+            st.write(f"Query result: {row_count} rows" +
+                (f", only the first {max_result_rows} can be displayed" if row_count > max_result_rows else ""))
+            page = st.number_input(f"Page (of {page_count})" , min_value=1 , max_value=page_count , value=1)
+            column_names, rows = getresultMain(code , page - 1)
+            st.dataframe([dict(zip(column_names, row)) for row in rows])
 
         st.markdown("""
         <style>
@@ -112,8 +241,8 @@ def running():
         agree = st.checkbox('Display Main Query Execution Plan')
         
         if(agree):
-            #generate annotated QEP tree
-            processQEPTree(val[1] , anno_list)
+            #generate annotated QEP tree from the QEP used for the annotation
+            processQEPTree(qep_root_node , anno_list, profile, fingerprint)
             annotation.print_annotations(anno_list)
             for anno in anno_list:
                 val=anno.split("\n")
@@ -121,5 +250,21 @@ def running():
                 st.write(val[1])
                 if(len(val)==3):
                     st.write(val[2])
+
+        if st.checkbox('Display Hottest Nodes'):
+            #nodes ranked by the time they take by themselves, without their children
+            for hot_node in annotation.generate_hot_nodes(qep_root_node.print_qep_steps(enable_print=False)):
+                st.write(hot_node)
+
+        if st.checkbox('Display Memory Sweep'):
+            #sorts and hashes that spill to disk, with the smallest work_mem that keeps them in memory
+            memory_sweep = getMemorySweep(code, qep_root_node)
+            if len(memory_sweep) == 0:
+                st.write("No sort or hash spills to disk.")
+            for line in memory_sweep:
+                st.write(line)
+
+        if st.checkbox('Display Profile'):
+            displayProfile(qep_root_node, profile)
     
     
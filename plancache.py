@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import planparser
+import re
+import sqlite3
+import threading
+import time
+
+default_cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".plan_cache.sqlite3")
+default_max_bytes = 256 * 1024 * 1024
+
+# Quoted strings and identifiers, dollar-quoted strings, and line and block comments, matched left to right
+# so that quotes inside comments and comment markers inside quotes are skipped
+token_pattern = re.compile(r"""(?P<quoted>'(?:[^']|'')*'|"(?:[^"]|"")*"|(?P<tag>\$(?:[A-Za-z_][A-Za-z0-9_]*)?\$)[\s\S]*?(?P=tag))
+    |(?P<comment>--[^\n]*|/\*[\s\S]*?\*/)""", re.X)
+whitespace_pattern = re.compile(r"\s+")
+
+def tokenizeQuery(query):
+    """
+    Splits a query into (kind, text) parts, where kind is "quoted" for quoted strings, identifiers
+    and dollar-quoted strings, "comment" for comments and "code" for everything else
+    """
+    parts = []
+    position = 0
+    for match in token_pattern.finditer(query):
+        if match.start() > position:
+            parts.append(("code", query[position:match.start()]))
+        parts.append(("comment" if match.group("comment") else "quoted", match.group()))
+        position = match.end()
+    if position < len(query):
+        parts.append(("code", query[position:]))
+    return parts
+
+def normalizeQuery(query):
+    """
+    Drops comments, collapses whitespace and case outside of quotes and drops the trailing semicolon,
+    so that the same query written differently shares cache entries
+    """
+    parts = []
+    code = ""
+    for kind, text in tokenizeQuery(query):
+        if kind == "quoted":
+            parts.append(whitespace_pattern.sub(" ", code).lower())
+            parts.append(text)
+            code = ""
+        else:
+            # A comment separates the code around it like whitespace
+            code += text if kind == "code" else " "
+    parts.append(whitespace_pattern.sub(" ", code).lower())
+    return "".join(parts).strip().rstrip(";").strip()
+
+def stripQuery(query):
+    """
+    Drops the comments and the trailing semicolon of a query, so that it can be run in a
+    cursor or wrapped in another query
+    """
+    text = "".join(text if kind != "comment" else " " for kind, text in tokenizeQuery(query))
+    return text.strip().rstrip(";").strip()
+
+class PlanCache:
+    """
+    An on-disk cache for plans in json format and annotations. Entries are keyed on the
+    normalized query, the planner settings and the version of the table statistics, and
+    the least recently used entries are evicted once the cache grows past max_bytes
+    """
+    def __init__(self, path=default_cache_path, max_bytes=default_max_bytes) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY, scope TEXT, stats_version TEXT, value TEXT, size INTEGER, last_used REAL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_scope ON entries (scope)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.conn.commit()
+
+    def makeKey(self, kind, query, settings, stats_version):
+        """
+        Returns the key of an entry and its scope, the key without the statistics version
+        """
+        scope = hashlib.sha1(json.dumps([kind, normalizeQuery(query), settings], sort_keys=True).encode()).hexdigest()
+        key = hashlib.sha1((scope + stats_version).encode()).hexdigest()
+        return key, scope
+
+    def get(self, kind, query, settings, stats_version):
+        """
+        Returns the cached value, or None if there is none for these statistics
+        """
+        key, scope = self.makeKey(kind, query, settings, stats_version)
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        return planparser.loads(row[0])
+
+    def put(self, kind, query, settings, stats_version, value):
+        """
+        Stores a value, replacing entries made with older statistics
+        """
+        key, scope = self.makeKey(kind, query, settings, stats_version)
+        value = json.dumps(value)
+        with self.lock:
+            self.conn.execute("DELETE FROM entries WHERE scope = ? AND stats_version != ?", (scope, stats_version))
+            self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (key, scope, stats_version, value, len(value), time.time()))
+            self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes
+        """
+        total_size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        rows = self.conn.execute("SELECT key, size FROM entries ORDER BY last_used").fetchall()
+        evicted = []
+        for key, size in rows:
+            if total_size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total_size -= size
+        self.conn.executemany("DELETE FROM entries WHERE key = ?", evicted)
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM entries")
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
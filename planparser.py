@@ -0,0 +1,140 @@
+import io
+import json
+
+# orjson decodes plans several times faster than the standard library when it is installed
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+# ijson parses plans incrementally when it is installed
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Fields of a Plan read when building Nodes and fingerprinting plans
+plan_fields = {
+    "Node Type", "Parent Relationship", "Strategy", "Join Type", "Plans",
+    "Startup Cost", "Total Cost", "Plan Rows", "Actual Startup Time", "Actual Total Time", "Actual Rows", "Actual Loops",
+    "Relation Name", "Alias", "Group Key", "Sort Method", "Sort Key", "Index Name", "Index Cond",
+    "Hash Cond", "Merge Cond", "Rows Removed by Filter", "Recheck Cond",
+    "Shared Hit Blocks", "Shared Read Blocks", "Shared Written Blocks",
+    "Local Hit Blocks", "Local Read Blocks", "Local Written Blocks",
+    "I/O Read Time", "I/O Write Time", "Shared I/O Read Time", "Shared I/O Write Time",
+    "Sort Space Used", "Sort Space Type", "Hash Batches", "Original Hash Batches", "HashAgg Batches",
+    "Peak Memory Usage", "Disk Usage", "Parallel Aware", "Workers Planned", "Workers Launched", "Workers",
+    "Single Copy",
+}
+
+# Fields read from the top level of a QEP, next to its Plan
+top_fields = {"Plan", "Planning Time", "Execution Time", "JIT", "Settings", "Timed Out", "Timeout Multiple", "Replica"}
+
+def decode_plan(raw_plan, streaming=False):
+    """
+    Takes the EXPLAIN (FORMAT JSON) output as text or bytes and returns the QEP in json format,
+    shaped like the rows of the EXPLAIN. With streaming, only the fields in plan_fields and
+    top_fields are kept and the plan is never decoded as a whole
+    """
+    # The driver already decoded the plan
+    if not isinstance(raw_plan, (str, bytes, bytearray, memoryview)):
+        return [[raw_plan]]
+
+    if not streaming:
+        return [[loads(raw_plan)]]
+    if ijson is not None:
+        return [[stream_plan(raw_plan)]]
+    return [[json.loads(bytes(raw_plan) if not isinstance(raw_plan, str) else raw_plan,
+        object_pairs_hook=select_fields)]]
+
+def select_fields(pairs):
+    """
+    Keeps only the fields that are read from Plans and from the top level of the QEP,
+    other objects such as JIT details are kept whole
+    """
+    fields = dict(pairs)
+    if "Node Type" in fields:
+        return {key: value for key, value in fields.items() if key in plan_fields}
+    if "Plan" in fields:
+        return {key: value for key, value in fields.items() if key in top_fields}
+    return fields
+
+def stream_plan(raw_plan):
+    """
+    Builds the QEP from the events of an incremental parser, skipping unread fields without
+    decoding them
+    """
+    if isinstance(raw_plan, str):
+        raw_plan = raw_plan.encode()
+
+    root = None
+    stack = [] # [container, kind, key] for each open object or array
+    skip_depth = 0 # Depth inside a skipped value
+    skip_value = False # Set when the next value belongs to a skipped field
+
+    for prefix, event, value in ijson.parse(io.BytesIO(bytes(raw_plan)), use_float=True):
+        # Skip the value of an unread field
+        if skip_depth:
+            if event == "start_map" or event == "start_array":
+                skip_depth += 1
+            elif event == "end_map" or event == "end_array":
+                skip_depth -= 1
+            continue
+        if skip_value:
+            skip_value = False
+            if event == "start_map" or event == "start_array":
+                skip_depth = 1
+            continue
+
+        if event == "map_key":
+            parent = stack[-1]
+            if parent[1] == "plan":
+                keep = value in plan_fields
+            elif parent[1] == "top":
+                keep = value in top_fields
+            else:
+                keep = True
+            parent[2] = value
+            skip_value = not keep
+            continue
+
+        if event == "end_map" or event == "end_array":
+            stack.pop()
+            continue
+
+        # Work out the kind of a new container from where it is
+        if event == "start_map" or event == "start_array":
+            container = {} if event == "start_map" else []
+            if not stack:
+                kind = "root"
+            else:
+                parent_container, parent_kind, parent_key = stack[-1]
+                if parent_kind == "root":
+                    kind = "top"
+                elif parent_kind == "top" and parent_key == "Plan":
+                    kind = "plan"
+                elif parent_kind == "plan" and parent_key == "Plans":
+                    kind = "plans"
+                elif parent_kind == "plans":
+                    kind = "plan"
+                else:
+                    kind = "full"
+            value = container
+        else:
+            kind = None
+
+        # Add the value to its parent
+        if not stack:
+            root = value
+        else:
+            parent_container, parent_kind, parent_key = stack[-1]
+            if isinstance(parent_container, list):
+                parent_container.append(value)
+            else:
+                parent_container[parent_key] = value
+
+        if kind is not None:
+            stack.append([value, kind, None])
+
+    return root
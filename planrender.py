@@ -0,0 +1,132 @@
+import threading
+from collections import Counter, OrderedDict, deque
+
+# Graphs are drawn with at most max_rendered_nodes plan nodes, the rest are collapsed into summary nodes
+max_rendered_nodes = 300
+# Subtrees below this depth are collapsed into a summary node
+max_rendered_depth = 30
+# Nodes with more children than this, such as an Append over many partitions, show only the first ones
+max_rendered_children = 8
+# Subplans that are collapsed until they are expanded
+collapsed_relationships = {"InitPlan", "SubPlan"}
+# Number of DOT sources kept in memory
+dot_cache_size = 32
+
+dot_cache = OrderedDict()
+dot_cache_lock = threading.Lock()
+
+def quoteDot(text):
+    """
+    Returns text as a quoted DOT string
+    """
+    return '"' + str(text).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+def getNodeLabel(node):
+    label = ("Parallel " if node.parallel_aware else "") + node.node_type
+    if node.relation_name is not None:
+        label += "\n" + str(node.relation_name)
+    return label
+
+def getAnnotationLabel(position, anno_list):
+    """
+    Returns the explanation line of the annotation of a step, or None if it has none
+    """
+    if position >= len(anno_list):
+        return None
+    lines = anno_list[position].split("\n")
+    if len(lines) == 3:
+        return lines[1].strip()
+    return None
+
+def summarizeSteps(step_list, subtrees):
+    """
+    Returns the number of nodes in the subtrees and their most common node types, read from
+    the step list where each subtree is a contiguous slice
+    """
+    node_types = Counter()
+    for subtree in subtrees:
+        node_types.update(step.node_type for step in step_list[subtree.subtree_start:subtree.position + 1])
+    size = sum(node_types.values())
+    common = ", ".join(f"{node_type} x{count}" for node_type, count in node_types.most_common(3))
+    return size, common
+
+def buildDot(qep_root_node, anno_list, expanded=frozenset()):
+    """
+    Builds the DOT source of the QEP tree with its annotations in one pass over the drawn nodes.
+    Deep subtrees, subplans, the extra children of wide nodes and everything past max_rendered_nodes
+    are drawn as summary nodes, unless their id is in expanded. Returns the DOT source and a dict
+    of the summary node ids to their labels
+    """
+    # Positions and subtree slices of the steps, in one pass
+    step_list = qep_root_node.print_qep_steps(enable_print=False)
+
+    lines = ["digraph {", "rankdir=BT bgcolor=lightblue margin=\"0.0 , 0.0\"", "node [shape=rect]"]
+    summaries = {}
+    rendered = 0
+
+    def addSummary(summary_id, parent_id, subtrees, reason):
+        size, common = summarizeSteps(step_list, subtrees)
+        label = f"{reason}: {size} nodes\n{common}"
+        summaries[summary_id] = label.replace("\n", ", ")
+        lines.append(f"{summary_id} [label={quoteDot(label)} style=dashed]")
+        lines.append(f"{summary_id} -> {parent_id} [dir=none style=dashed]")
+
+    # Breadth first, so the top of the plan is drawn first when the node budget runs out
+    queue = deque([(qep_root_node, None, 0)])
+    while queue:
+        node, parent_id, depth = queue.popleft()
+        node_id = f"n{node.position}"
+        summary_id = f"s{node.position}"
+
+        if summary_id not in expanded and parent_id is not None:
+            if node.parent_relationship in collapsed_relationships:
+                addSummary(summary_id, parent_id, [node], node.parent_relationship)
+                continue
+            if depth >= max_rendered_depth:
+                addSummary(summary_id, parent_id, [node], "Deep subtree")
+                continue
+            if rendered >= max_rendered_nodes:
+                addSummary(summary_id, parent_id, [node], "Subtree")
+                continue
+
+        rendered += 1
+        lines.append(f"{node_id} [label={quoteDot(getNodeLabel(node))}]")
+        if parent_id is not None:
+            lines.append(f"{node_id} -> {parent_id} [dir=none]")
+
+        # Link the annotation of the node to it
+        anno_label = getAnnotationLabel(node.position, anno_list)
+        if anno_label is not None:
+            lines.append(f"a{node.position} [label={quoteDot(anno_label)} color=red]")
+            lines.append(f"a{node.position} -> {node_id} [color=red]")
+
+        children = node.children
+        children_id = f"c{node.position}"
+        if len(children) > max_rendered_children and children_id not in expanded:
+            addSummary(children_id, node_id, children[max_rendered_children:],
+                f"{len(children) - max_rendered_children} more children")
+            children = children[:max_rendered_children]
+        for child in children:
+            queue.append((child, node_id, depth + 1))
+
+    lines.append("}")
+    return "\n".join(lines), summaries
+
+def getDot(qep_root_node, anno_list, fingerprint=None, expanded=frozenset()):
+    """
+    Returns buildDot of the QEP tree, cached by the fingerprint of the plan when one is given
+    """
+    if fingerprint is None:
+        return buildDot(qep_root_node, anno_list, expanded)
+
+    key = (fingerprint, tuple(anno_list), frozenset(expanded))
+    with dot_cache_lock:
+        if key in dot_cache:
+            dot_cache.move_to_end(key)
+            return dot_cache[key]
+    dot = buildDot(qep_root_node, anno_list, expanded)
+    with dot_cache_lock:
+        dot_cache[key] = dot
+        while len(dot_cache) > dot_cache_size:
+            dot_cache.popitem(last=False)
+    return dot
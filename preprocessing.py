@@ -1,67 +1,1005 @@
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+import planparser
+from plancache import stripQuery
+import profiling
+import hashlib
 import json
 import queue
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+# Default page costs of the planner, EXPLAIN (SETTINGS) only reports them when they were changed
 default_seqpage_cost = 1.0
 default_randompage_cost = 4.0
 
+# Server version from which EXPLAIN takes the SETTINGS option
+explain_settings_version = 120000
+
+# Maximum number of open connections for each database
+max_pool_connections = 10
+
+# Number of rows of query results fetched from the server for each page
+default_page_size = 100
+
+# Ways of collecting the plans
+analyze_mode = "analyze" # EXPLAIN ANALYZE every plan
+estimate_mode = "estimate" # Plain EXPLAIN, annotations use the planner's cost estimates
+hybrid_mode = "hybrid" # Plain EXPLAIN for the AQPs, EXPLAIN ANALYZE for the QEP and the closest competitor
+plan_modes = [analyze_mode, estimate_mode, hybrid_mode]
+
+# Smallest statement timeout in ms given to an analyzed AQP
+min_statement_timeout = 100
+
+# work_mem values in kB tried by the memory sweep, from 4MB to 1GB
+work_mem_sweep = [4096, 16384, 65536, 262144, 1048576]
+# hash_mem_multiplier values tried by the memory sweep when hashes spill, from PostgreSQL 13
+hash_mem_multiplier_sweep = [1.0, 2.0, 4.0, 8.0]
+hash_mem_multiplier_version = 130000
+
+# max_parallel_workers_per_gather values of the AQPs of plans with parallel subtrees, 0 runs them without workers
+parallel_workers_sweep = [0, 1, 2, 4, 8]
+# Nodes that collect the rows of the workers of a parallel subtree
+gather_node_types = ["Gather", "Gather Merge"]
+
+# Evicts the shared buffers of the current database before a cold run, pg_buffercache_evict
+# is only in PostgreSQL 17 and later. Dirty buffers and buffers in use are left in place
+evict_buffers_query = """
+SELECT count(pg_buffercache_evict(bufferid)) FROM pg_buffercache
+WHERE reldatabase = (SELECT oid FROM pg_database WHERE datname = current_database())"""
+
+# Planner settings toggled by the AQPs, enable_incremental_sort and enable_memoize
+# only exist from PostgreSQL 13 and 14 and are left out on older servers
+planner_settings = ["enable_hashjoin", "enable_mergejoin", "enable_nestloop",
+    "enable_bitmapscan", "enable_indexscan", "enable_seqscan", "enable_indexonlyscan",
+    "enable_hashagg", "enable_sort", "enable_incremental_sort", "enable_material", "enable_memoize"]
+
+# Operator names of the strategies of Aggregate nodes
+aggregate_strategies = {"Hashed": "HashAggregate", "Sorted": "GroupAggregate", "Mixed": "MixedAggregate"}
+
+# Operators, node types or aggregate strategies, that each planner setting can remove from a plan
+setting_node_types = {
+    "enable_hashjoin": ["Hash Join"],
+    "enable_mergejoin": ["Merge Join"],
+    "enable_nestloop": ["Nested Loop"],
+    "enable_bitmapscan": ["Bitmap Heap Scan", "Bitmap Index Scan"],
+    "enable_indexscan": ["Index Scan", "Index Only Scan"],
+    "enable_seqscan": ["Seq Scan"],
+    "enable_indexonlyscan": ["Index Only Scan"],
+    "enable_hashagg": ["HashAggregate", "MixedAggregate"],
+    "enable_sort": ["Sort"],
+    "enable_incremental_sort": ["Incremental Sort"],
+    "enable_material": ["Materialize"],
+    "enable_memoize": ["Memoize"],
+}
+
+# Hash of the table statistics, which changes after ANALYZE and after changes to the data
+stats_version_query = """
+SELECT md5(COALESCE(string_agg(concat_ws(':', c.oid, c.reltuples, c.relpages, s.n_tup_ins, s.n_tup_upd,
+    s.n_tup_del, s.analyze_count, s.autoanalyze_count), ',' ORDER BY c.oid), ''))
+FROM pg_class c JOIN pg_stat_user_tables s ON s.relid = c.oid"""
+
+# Row and page counts of each table and index, which must be about the same on every replica for their
+# plans to be compared, so an index missing on a replica is caught too. Relations are named rather than
+# identified by oid, which differs between separately loaded instances. ANALYZE estimates the counts from
+# a sample of the table, so they are compared within a tolerance, and the column statistics built from
+# the sampled rows are not compared at all
+replica_tables_query = """
+SELECT c.oid::regclass::text, c.reltuples, c.relpages
+FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname NOT IN ('pg_catalog', 'information_schema', 'pg_toast') AND c.relkind IN ('r', 'm', 'p', 'i', 'I')"""
+# Hash of the query tuning settings, which must be the same on every replica
+replica_settings_query = """
+SELECT md5(string_agg(name || '=' || setting, ',' ORDER BY name)) FROM pg_settings WHERE category LIKE 'Query Tuning%'"""
+# Relative difference allowed between the row or page counts of a table on two replicas
+replica_stats_tolerance = 0.05
+
+# Plan keys that make up the fingerprint of a plan's structure and operators
+plan_fingerprint_keys = ["Node Type", "Parent Relationship", "Strategy", "Join Type",
+    "Relation Name", "Alias", "Index Name"]
+
+# Planner settings used for the AQPs without each join operator
+no_join_settings = [
+    {"enable_mergejoin": False},
+    {"enable_hashjoin": False},
+]
+
+# Planner settings used for the AQPs without each scan operator
+no_scan_settings = [
+    {"enable_bitmapscan": False},
+    {"enable_indexscan": False},
+    {"enable_indexonlyscan": False},
+    {"enable_bitmapscan": False, "enable_indexscan": False},
+    {"enable_bitmapscan": False, "enable_indexonlyscan": False},
+    {"enable_bitmapscan": False, "enable_indexscan": False, "enable_indexonlyscan": False},
+]
+
+# Planner settings used for the AQPs without each aggregation, sort and caching operator
+no_operator_settings = [
+    {"enable_hashagg": False},
+    {"enable_sort": False},
+    {"enable_incremental_sort": False},
+    {"enable_material": False},
+    {"enable_memoize": False},
+]
+
+class QueryTimeout(RuntimeError):
+    """
+    Raised when the plans of a query run past the deadline of the query
+    """
+
+class TrackedConnection(psycopg2.extensions.connection):
+    """
+    A connection that remembers the session values of the planner settings
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.session_settings = None
+
+class ConnectionPool:
+    """
+    A bounded pool of reusable connections to one database. Connections are only
+    opened when they are first needed, checked before they are handed out and have
+    their session settings reset when they are returned
+    """
+    def __init__(self, maxconn=max_pool_connections, timeout=30, ping_after=1.0, **params) -> None:
+        self.params = params
+        self.maxconn = maxconn
+        self.timeout = timeout # Seconds to wait for a free connection
+        self.ping_after = ping_after # Seconds a connection can be idle before it is pinged
+        self.idle = [] # (connection, time returned) pairs
+        self.size = 0 # Number of open connections, idle or in use
+        self.lock = threading.Condition()
+
+    def getconn(self):
+        """
+        Returns a healthy connection, opening a new one only if none is idle
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn = None
+            with self.lock:
+                while not self.idle and self.size >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise psycopg2.pool.PoolError("connection pool exhausted")
+                    self.lock.wait(remaining)
+                if self.idle:
+                    conn, returned = self.idle.pop()
+                else:
+                    self.size += 1
+
+            # Open a new connection outside of the lock
+            if conn is None:
+                try:
+                    return psycopg2.connect(connection_factory=TrackedConnection, **self.params)
+                except psycopg2.Error:
+                    self.discard(None)
+                    raise
+
+            if self.isHealthy(conn, time.monotonic() - returned):
+                return conn
+            self.discard(conn)
+
+    def isHealthy(self, conn, idle_time):
+        """
+        Checks that an idle connection is still usable
+        """
+        if conn.closed:
+            return False
+        if idle_time < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def putconn(self, conn):
+        """
+        Resets the session settings of the connection and returns it to the pool
+        """
+        try:
+            conn.rollback()
+            with conn.cursor() as cursor:
+                cursor.execute("RESET ALL")
+            conn.commit()
+        except psycopg2.Error:
+            self.discard(conn)
+            return
+        with self.lock:
+            self.idle.append((conn, time.monotonic()))
+            self.lock.notify()
+
+    def discard(self, conn):
+        """
+        Closes a broken connection and frees its place in the pool
+        """
+        if conn is not None and not conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+        with self.lock:
+            self.size -= 1
+            self.lock.notify()
+
+    def closeall(self):
+        """
+        Closes all idle connections
+        """
+        with self.lock:
+            for conn, returned in self.idle:
+                conn.close()
+            self.size -= len(self.idle)
+            self.idle = []
+
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+
+def getConnectionPool(**params):
+    """
+    Returns the pool shared by all connections with the same parameters
+    """
+    key = tuple(sorted(params.items()))
+    with connection_pools_lock:
+        if key not in connection_pools:
+            connection_pools[key] = ConnectionPool(**params)
+        return connection_pools[key]
+
 class DBConnection:
-    # Open connection to DB, enter your database name and password
-    # Change this accordingly
-    def __init__(self, host="localhost", port = 5432, database="TPC-H", user="postgres", password="postgres") -> None:
-        self.conn = psycopg2.connect(host=host, port=port, database=database, user=user, password=password)
-        self.cur = self.conn.cursor()
+    # Connection to DB borrowed from the shared pool, enter your database name and password
+    # Change this accordingly, or give a dsn such as "host=localhost port=5433 dbname=TPC-H"
+    def __init__(self, host="localhost", port = 5432, database="TPC-H", user="postgres", password="postgres", dsn=None) -> None:
+        if dsn is not None:
+            self.params = dict(dsn=dsn)
+        else:
+            self.params = dict(host=host, port=port, database=database, user=user, password=password)
+        self.pool = getConnectionPool(**self.params)
+        self.conn = None
+        self.cur = None
+
+    def open(self):
+        """
+        Borrows a connection from the pool the first time it is needed
+        """
+        if self.conn is None:
+            self.conn = self.pool.getconn()
+            self.cur = self.conn.cursor()
+        return self.cur
 
     def execute(self, query):
-        self.cur.execute(query)
-        query_results = self.cur.fetchall()
+        cursor = self.open()
+        cursor.execute(query)
+        query_results = cursor.fetchall()
         return query_results
 
+    def fetchPage(self, query, page, page_size=default_page_size):
+        """
+        Returns the column names and the rows of one page of a query
+        """
+        self.open()
+        cursor = self.conn.cursor(name="query_result")
+        try:
+            cursor.execute(stripQuery(query))
+            if page > 0:
+                cursor.scroll(page * page_size)
+            rows = cursor.fetchmany(page_size)
+            column_names = [column[0] for column in cursor.description]
+        finally:
+            cursor.close()
+            self.conn.rollback()
+        return column_names, rows
+
+    def countRows(self, query):
+        """
+        Returns the number of rows of a query, counted on the server without fetching them
+        """
+        cursor = self.open()
+        cursor.execute(f"SELECT count(*) FROM ({stripQuery(query)}) AS query_result")
+        row_count = cursor.fetchone()[0]
+        self.conn.rollback()
+        return row_count
+
     def close(self):
-        self.cur.close()
-        self.conn.close()
+        """
+        Returns the connection to the pool
+        """
+        if self.conn is not None:
+            self.cur.close()
+            self.pool.putconn(self.conn)
+            self.conn = None
+            self.cur = None
 
 class QueryPlanGenerator:
-    def __init__(self) -> None:
-        self.connection = DBConnection()
+    # Set parallel to True to run the AQPs at the same time, each on its own connection
+    # mode is one of plan_modes
+    # Set timeout_multiple to cancel analyzed AQPs that run that many times longer than the QEP
+    # cache is an optional plancache.PlanCache the plans are read from and stored in
+    # Set streaming to decode large plans incrementally, keeping only the fields that are read
+    # Set query_timeout to cancel any analyzed plan, QEP or AQP, that runs longer than that many ms
+    # profile is the profiling.Profile the time of each phase is recorded in, a new one by default
+    # Set repeats to run the QEP and the AQPs that many times in analyze mode, after warmup runs that are not
+    # measured, and cold to evict the shared buffers of the database before each measured run
+    # replicas is a list of DSNs, or dicts of connection parameters, of identical replicas of the database.
+    # The QEP runs on the first one and the AQPs are spread across all of them
+    # Set deadline, a time.monotonic() time, to give the statements of a query only the time left before it
+    def __init__(self, parallel=False, max_workers=4, mode=analyze_mode, timeout_multiple=None, cache=None,
+        streaming=False, query_timeout=None, profile=None, repeats=1, warmup=0, cold=False, replicas=None) -> None:
+        if mode not in plan_modes:
+            raise ValueError(f"Unknown plan mode {mode}, expected one of {plan_modes}")
+        self.replicas = [getReplicaParams(replica) for replica in replicas] if replicas else None
+        self.connection = DBConnection(**self.replicas[0]) if self.replicas else DBConnection()
+        if self.replicas:
+            self.replica_names = [getReplicaName(params) for params in self.replicas]
+            self.replica_load = [0] * len(self.replicas) # AQPs running on each replica
+            self.replica_runs = [0] * len(self.replicas) # AQPs run on each replica so far
+            self.replica_lock = threading.Lock()
+            self.replica_stats_version = None # Statistics version of the first replica when the replicas were checked
+        self.parallel = parallel
+        self.max_workers = max_workers
+        self.mode = mode
+        self.timeout_multiple = timeout_multiple
+        self.qep_time = None # Execution time of the last analyzed QEP in ms
+        self.qep_query = None # Query of the last QEP
+        self.qep_node_types = None # Node types used in the last QEP
+        self.qep_fingerprint = None # Fingerprint of the last QEP
+        self.qep_plan = None # Last QEP, measured runs write the run times of its nodes into it
+        self.cache = cache
+        self.streaming = streaming
+        self.query_timeout = query_timeout
+        self.profile = profile if profile is not None else profiling.Profile()
+        self.stats_query = None # Query the statistics version was last read for
+        self.stats_version = None
+        self.repeats = repeats
+        self.warmup = warmup
+        self.cold = cold
+        self.deadline = None # Time by which every plan of the current query must be done
 
     def getAQP(self, query, enable_hashjoin=True, enable_mergejoin=True, enable_nestloop=True,
-        enable_bitmapscan=True, enable_indexscan=True, enable_seqscan=True, enable_indexonlyscan=True):
-        cursor = self.connection.cur
-        cursor.execute("SET enable_hashjoin TO 1") if enable_hashjoin else cursor.execute("SET enable_hashjoin TO 0")
-        cursor.execute("SET enable_mergejoin TO 1") if enable_mergejoin else cursor.execute("SET enable_mergejoin TO 0")
-        cursor.execute("SET enable_nestloop TO 1") if enable_nestloop else cursor.execute("SET enable_nestloop TO 0")
-        cursor.execute("SET enable_bitmapscan TO 1") if enable_bitmapscan else cursor.execute("SET enable_bitmapscan TO 0")
-        cursor.execute("SET enable_indexscan TO 1") if enable_indexscan else cursor.execute("SET enable_indexscan TO 0")
-        cursor.execute("SET enable_seqscan TO 1") if enable_seqscan else cursor.execute("SET enable_seqscan TO 0")
-        cursor.execute("SET enable_indexonlyscan TO 1") if enable_indexonlyscan else cursor.execute("SET enable_indexonlyscan TO 0")
-
-        cursor.execute(cursor.mogrify("EXPLAIN (ANALYZE, FORMAT JSON) " + query))
-        query_plan = cursor.fetchall()
+        enable_bitmapscan=True, enable_indexscan=True, enable_seqscan=True, enable_indexonlyscan=True,
+        enable_hashagg=True, enable_sort=True, enable_incremental_sort=True, enable_material=True, enable_memoize=True,
+        cursor=None, analyze=True, timeout=None, use_cache=True, values=None):
+        if cursor is None:
+            with self.profile.phase("connect"):
+                cursor = self.connection.open()
+        settings = dict(enable_hashjoin=enable_hashjoin, enable_mergejoin=enable_mergejoin, enable_nestloop=enable_nestloop,
+            enable_bitmapscan=enable_bitmapscan, enable_indexscan=enable_indexscan, enable_seqscan=enable_seqscan,
+            enable_indexonlyscan=enable_indexonlyscan, enable_hashagg=enable_hashagg, enable_sort=enable_sort,
+            enable_incremental_sort=enable_incremental_sort, enable_material=enable_material, enable_memoize=enable_memoize)
+        # Settings with a value that differ from the session, such as work_mem in kB
+        values = values or {}
+        plan_name = getPlanName(settings, values)
+
+        # Plans for the same query, settings and table statistics are read from the cache,
+        # except for measured runs which must run every time
+        cache = self.cache if use_cache else None
+        if cache is not None:
+            stats_version = self.stats_version if self.stats_query == query else self.getStatsVersion(cursor)
+            cache_settings = dict(settings, analyze=analyze, buffers=analyze, verbose=analyze, **values)
+            with self.profile.phase("cache lookup", plan=plan_name):
+                query_plan = cache.get("plan", query, cache_settings, stats_version)
+            if query_plan is not None:
+                return query_plan
+
+        # Only send the settings that differ from the session, together with the EXPLAIN.
+        # SET LOCAL lasts until the rollback, so the settings never leak to later queries.
+        # Settings the server does not have are skipped
+        with self.profile.phase("session settings"):
+            session_settings = self.getSessionSettings(cursor)
+        statements = [f"SET LOCAL {name} TO {'on' if value else 'off'}"
+            for name, value in settings.items() if name in session_settings and session_settings[name] != value]
+        statements.extend(f"SET LOCAL {name} TO {value}" for name, value in values.items())
+        timeout = self.getStatementTimeout(timeout)
+        if timeout is not None:
+            statements.append(f"SET LOCAL statement_timeout TO {int(timeout)}")
+        statements.append(getExplain(query, analyze, cursor.connection.server_version))
+
+        # Fetch the plan as text and decode it with planparser instead of the driver's json decoder.
+        # The raw loader is only registered on a cursor of its own, so json columns of other queries
+        # on the connection are still decoded. The SET statements are sent with the EXPLAIN, so their
+        # time is part of the explain phase
+        explain_cursor = cursor.connection.cursor()
+        psycopg2.extras.register_default_json(explain_cursor, loads=lambda raw_plan: raw_plan)
+        try:
+            with self.profile.phase("explain", plan=plan_name, analyze=analyze, statements=len(statements)):
+                explain_cursor.execute(";\n".join(statements))
+                raw_plan = explain_cursor.fetchone()[0]
+            with self.profile.phase("decode", plan=plan_name):
+                query_plan = planparser.decode_plan(raw_plan, streaming=self.streaming)
+            # Plans are tagged with the replica that produced them
+            if self.replicas is not None:
+                query_plan[0][0][0]['Replica'] = getReplicaName(cursor.connection.get_dsn_parameters())
+                self.profile.addPlanTimes(plan_name, query_plan, analyze=analyze, replica=query_plan[0][0][0]['Replica'])
+            else:
+                self.profile.addPlanTimes(plan_name, query_plan, analyze=analyze)
+        except psycopg2.errors.QueryCanceled:
+            if timeout is None:
+                raise
+            query_plan = None
+        finally:
+            explain_cursor.close()
+            cursor.connection.rollback()
+
+        # The AQP ran past its time budget, keep its structure from the estimated plan
+        if query_plan is None:
+            query_plan = self.getAQP(query, cursor=cursor, analyze=False, use_cache=use_cache, values=values, **settings)
+            self.markTimedOut(query_plan, timeout)
+        # Cancelled plans depend on the time budget, so they are not cached
+        elif cache is not None:
+            with self.profile.phase("cache store", plan=plan_name):
+                cache.put("plan", query, cache_settings, stats_version, query_plan)
+        return query_plan
+
+    def markTimedOut(self, query_plan, timeout):
+        """
+        Marks the estimated plan of a cancelled AQP with its time budget in ms
+        """
+        query_plan[0][0][0]['Timed Out'] = timeout
+        if self.qep_time:
+            query_plan[0][0][0]['Timeout Multiple'] = round(timeout / self.qep_time, 2)
+
+    def getStatsVersion(self, cursor=None):
+        """
+        Returns a hash of the table statistics, used to invalidate cached plans
+        """
+        if cursor is None:
+            with self.profile.phase("connect"):
+                cursor = self.connection.open()
+        try:
+            with self.profile.phase("stats version"):
+                cursor.execute(stats_version_query)
+                stats_version = cursor.fetchone()[0]
+        finally:
+            # End the transaction so that the next read sees fresh statistics
+            cursor.connection.rollback()
+        return stats_version
+
+    def getSessionSettings(self, cursor):
+        """
+        Returns the session values of the planner settings, read once for each connection
+        """
+        conn = cursor.connection
+        if getattr(conn, "session_settings", None) is None:
+            cursor.execute("SELECT name, setting FROM pg_settings WHERE name = ANY(%s)", (planner_settings,))
+            session_settings = {name: setting == "on" for name, setting in cursor.fetchall()}
+            if not isinstance(conn, TrackedConnection):
+                return session_settings
+            conn.session_settings = session_settings
+        return conn.session_settings
+
+    def getQEP(self, query):
+        """
+        Generates the QEP with the default planner settings. It is analyzed unless
+        only estimates are collected
+        """
+        stats_version = self.getStatsVersion() if self.cache is not None or self.replicas is not None else None
+        # The replicas are only checked again once the statistics of the first one change
+        if self.replicas is not None and stats_version != self.replica_stats_version:
+            self.checkReplicas()
+            self.replica_stats_version = stats_version
+        if self.cache is not None:
+            self.stats_version = stats_version
+            self.stats_query = query
+        # A cancelled QEP has no QEP time to be measured against, not even the one of the previous query
+        self.qep_time = None
+        analyze = self.mode != estimate_mode
+        with self.profile.phase("qep"):
+            query_plan = self.getAQP(query, analyze=analyze, timeout=self.query_timeout if analyze else None)
+        self.setQEP(query, query_plan)
+        return query_plan
+
+    def setQEP(self, query, query_plan):
+        """
+        Keeps what the AQPs of the query are compared against and selected by
+        """
+        self.qep_time = query_plan[0][0][0].get('Execution Time')
+        self.qep_query = query
+        self.qep_node_types = set(getOperatorName(plan['Node Type'], plan.get('Strategy')) for plan in walkPlan(query_plan))
+        self.qep_fingerprint = getPlanFingerprint(query_plan)
+        self.qep_plan = query_plan
+
+    def selectSettings(self, query, settings_list):
+        """
+        Keeps only the planner settings that disable an operator used in the QEP of the query,
+        the others cannot change the plan
+        """
+        if self.qep_query != query:
+            return settings_list
+        return [settings for settings in settings_list
+            if any(not value and any(node_type in self.qep_node_types for node_type in setting_node_types[name])
+                for name, value in settings.items())]
+
+    def selectAllSettings(self, query):
+        """
+        Returns the planner settings of the no join, no scan and no operator AQPs of the query
+        """
+        return (self.selectSettings(query, no_join_settings), self.selectSettings(query, no_scan_settings),
+            self.selectSettings(query, no_operator_settings))
+
+    def selectUniquePlans(self, query, aqps_list):
+        """
+        Returns the positions of the AQPs that differ in structure or operators from the QEP and from the
+        AQPs before them. AQPs that are None have not been generated yet and are skipped
+        """
+        seen = set([self.qep_fingerprint]) if self.qep_query == query else set()
+        unique_positions = []
+        for i, aqp in enumerate(aqps_list):
+            if aqp is None:
+                continue
+            fingerprint = getPlanFingerprint(aqp)
+            if fingerprint not in seen:
+                seen.add(fingerprint)
+                unique_positions.append(i)
+        return unique_positions
+
+    def removeDuplicatePlans(self, query, aqps_list):
+        """
+        Collapses AQPs with the same structure and operators, and AQPs identical to the QEP
+        """
+        return [aqps_list[i] for i in self.selectUniquePlans(query, aqps_list)]
+
+    def selectClosestAQP(self, aqps_list):
+        """
+        Returns the position of the AQP the planner estimated to be closest to the QEP, the only one
+        analyzed in hybrid mode, or None in the other modes
+        """
+        if self.mode != hybrid_mode or len(aqps_list) == 0:
+            return None
+        return min(range(len(aqps_list)), key=lambda i: getPlanCost(aqps_list[i]))
+
+    def hasParallelSubtrees(self, query):
+        """
+        Returns whether the parallel AQPs of the query can differ from its QEP, which needs a Gather in the QEP
+        """
+        return self.qep_query != query or any(node_type in self.qep_node_types for node_type in gather_node_types)
+
+    def selectParallelValues(self, session_workers):
+        """
+        Returns the values of the parallel AQPs, each number of workers in parallel_workers_sweep other than
+        the session value. They run one at a time, after the other AQPs, so that the workers of one do not
+        take the cores of another
+        """
+        return [{"max_parallel_workers_per_gather": workers} for workers in parallel_workers_sweep
+            if workers != session_workers]
+
+    def getTimeBudget(self):
+        """
+        Returns the statement timeout in ms for an analyzed AQP, a multiple of the QEP's execution time
+        that is no longer than query_timeout
+        """
+        if self.timeout_multiple is None or self.qep_time is None:
+            return self.query_timeout
+        budget = max(min_statement_timeout, self.timeout_multiple * self.qep_time)
+        if self.query_timeout is not None:
+            budget = min(budget, self.query_timeout)
+        return budget
+
+    def getStatementTimeout(self, timeout):
+        """
+        Returns the statement timeout in ms of the next plan, timeout cut down to the time left before
+        the deadline. Raises QueryTimeout once the deadline has passed
+        """
+        if self.deadline is None:
+            return timeout
+        remaining = (self.deadline - time.monotonic()) * 1000
+        # A statement_timeout of 0 would disable the timeout
+        if remaining < 1:
+            raise QueryTimeout("The plans of the query ran past its deadline")
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def checkReplicas(self):
+        """
+        Checks that the row and page counts of the tables and indexes and the query tuning settings of every
+        replica match those of the first one, so that an AQP is planned the same way whichever replica runs it
+        """
+        replica_stats = []
+        with self.profile.phase("replica check", count=len(self.replicas)):
+            for params in self.replicas:
+                connection = DBConnection(**params)
+                try:
+                    cursor = connection.open()
+                    cursor.execute(replica_tables_query)
+                    tables = {name: (reltuples, relpages) for name, reltuples, relpages in cursor.fetchall()}
+                    cursor.execute(replica_settings_query)
+                    replica_stats.append((tables, cursor.fetchone()[0]))
+                    connection.conn.rollback()
+                finally:
+                    connection.close()
+
+        mismatches = []
+        first_tables, first_settings = replica_stats[0]
+        for name, (tables, settings) in zip(self.replica_names[1:], replica_stats[1:]):
+            differences = [describeTableMismatch(table, first_tables.get(table), tables.get(table))
+                for table in sorted(first_tables.keys() | tables.keys())]
+            differences = [difference for difference in differences if difference is not None]
+            if settings != first_settings:
+                differences.append("query tuning settings")
+            if len(differences) != 0:
+                mismatches.append(f"{name} ({', '.join(differences)})")
+        if len(mismatches) != 0:
+            raise RuntimeError(f"Replicas do not match {self.replica_names[0]}: {'; '.join(mismatches)}. " +
+                "Run ANALYZE on every replica after loading the same data and use the same settings")
+
+    def acquireReplica(self):
+        """
+        Returns the replica running the fewest AQPs, the one that ran the fewest so far among those,
+        so that faster replicas take more of the AQPs
+        """
+        with self.replica_lock:
+            replica = min(range(len(self.replicas)), key=lambda i: (self.replica_load[i], self.replica_runs[i]))
+            self.replica_load[replica] += 1
+            self.replica_runs[replica] += 1
+        return replica
+
+    def releaseReplica(self, replica):
+        with self.replica_lock:
+            self.replica_load[replica] -= 1
+
+    def getPooledAQP(self, query, settings, analyze=True, timeout=None):
+        """
+        Generates one AQP on a connection borrowed from the pool, of the least loaded replica when there are replicas
+        """
+        replica = self.acquireReplica() if self.replicas is not None else None
+        connection = DBConnection(**(self.replicas[replica] if replica is not None else self.connection.params))
+        try:
+            with self.profile.phase("connect"):
+                cursor = connection.open()
+            query_plan = self.getAQP(query, cursor=cursor, analyze=analyze, timeout=timeout, **settings)
+        finally:
+            connection.close()
+            if replica is not None:
+                self.releaseReplica(replica)
         return query_plan
 
+    def evictBuffers(self, cursor):
+        """
+        Evicts the shared buffers of the database, so that the next run reads its pages from the
+        operating system's cache or from disk
+        """
+        try:
+            with self.profile.phase("evict buffers"):
+                cursor.execute(evict_buffers_query)
+        except (psycopg2.errors.UndefinedTable, psycopg2.errors.UndefinedFunction):
+            raise RuntimeError("Cold runs need the pg_buffercache extension of PostgreSQL 17 or later, " +
+                "CREATE EXTENSION pg_buffercache")
+        finally:
+            cursor.connection.rollback()
+
+    def measurePlans(self, query, settings_list):
+        """
+        Runs the plan of each dict of planner settings warmup times, then repeats times in rounds
+        whose order rotates, so that every plan takes every place in the order as often and none
+        always finds the buffers another one loaded. Plans that are cancelled are not run again.
+        Returns the runs of each plan, in the same order as settings_list
+        """
+        timeout = self.getTimeBudget()
+        with self.profile.phase("connect"):
+            cursor = self.connection.open()
+        runs = [[] for _ in settings_list]
+
+        with self.profile.phase("warm-up", count=self.warmup * len(settings_list)):
+            for _ in range(self.warmup):
+                for settings in settings_list:
+                    self.getAQP(query, cursor=cursor, timeout=timeout, use_cache=False, **settings)
+
+        for run in range(self.repeats):
+            for offset in range(len(settings_list)):
+                i = (run + offset) % len(settings_list)
+                if len(runs[i]) != 0 and 'Timed Out' in runs[i][-1][0][0][0]:
+                    continue
+                if self.cold:
+                    self.evictBuffers(cursor)
+                with self.profile.phase("aqp", plan=getPlanName(settings_list[i]), analyze=True, run=run + 1):
+                    runs[i].append(self.getAQP(query, cursor=cursor, timeout=timeout, use_cache=False,
+                        **settings_list[i]))
+        return runs
+
+    def generateMeasuredAQPsList(self, query, settings_list):
+        """
+        Measures the AQPs of each dict of planner settings together with the QEP, in the same order.
+        The runs are sequential whatever parallel is, so that they do not slow each other down.
+        The QEP returned by getQEP gets the run times of its nodes from its own runs
+        """
+        measure_qep = self.qep_query == query
+        with self.profile.phase("aqps", count=len(settings_list), repeats=self.repeats):
+            runs = self.measurePlans(query, [{}] + settings_list if measure_qep else settings_list)
+        if measure_qep:
+            mergeRuns(runs.pop(0), self.qep_plan)
+        return [mergeRuns(plan_runs) for plan_runs in runs]
+
+    def generateAQPsList(self, query, settings_list):
+        """
+        Generates one AQP for each dict of planner settings, in the same order
+        """
+        analyze = self.mode == analyze_mode
+        # Warm-up runs and cold buffers also apply to a single run of each plan
+        if analyze and (self.repeats > 1 or self.warmup > 0 or self.cold):
+            return self.generateMeasuredAQPsList(query, settings_list)
+        timeout = self.getTimeBudget() if analyze else None
+
+        # With replicas, each AQP runs on a replica even when they run one at a time
+        def generateAQP(settings):
+            with self.profile.phase("aqp", plan=getPlanName(settings), analyze=analyze):
+                if not self.parallel and self.replicas is None:
+                    return self.getAQP(query, analyze=analyze, timeout=timeout, **settings)
+                return self.getPooledAQP(query, settings, analyze, timeout)
+
+        with self.profile.phase("aqps", count=len(settings_list)):
+            if not self.parallel:
+                aqps_list = [generateAQP(settings) for settings in settings_list]
+            else:
+                # Each worker runs its AQP on its own pooled connection with its own session settings
+                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    aqps_list = list(executor.map(generateAQP, settings_list))
+
+            # Only analyze the AQP the planner estimated to be closest to the QEP
+            closest = self.selectClosestAQP(aqps_list)
+            if closest is not None:
+                with self.profile.phase("aqp", plan=getPlanName(settings_list[closest]), analyze=True):
+                    aqps_list[closest] = self.getAQP(query, timeout=self.getTimeBudget(), **settings_list[closest])
+        return aqps_list
+
+    # The AQP lists only cover operators used in the QEP when getQEP was called for the query first
     def generateNoJoinAQPsList(self, query):
-        noJoinList = []
-        noJoinList.append(self.getAQP(query, enable_mergejoin=False))
-        noJoinList.append(self.getAQP(query, enable_hashjoin=False))
-        return noJoinList
+        aqps_list = self.generateAQPsList(query, self.selectSettings(query, no_join_settings))
+        return self.removeDuplicatePlans(query, aqps_list)
 
     def generateNoScanAQPsList(self, query):
-        noScanList = []
-        noScanList.append(self.getAQP(query, enable_bitmapscan=False))
-        noScanList.append(self.getAQP(query, enable_indexscan=False))
-        noScanList.append(self.getAQP(query, enable_indexonlyscan=False))
-        noScanList.append(self.getAQP(query, enable_bitmapscan=False, enable_indexscan=False))
-        noScanList.append(self.getAQP(query, enable_bitmapscan=False, enable_indexonlyscan=False))
-        noScanList.append(self.getAQP(query, enable_bitmapscan=False, enable_indexscan=False, enable_indexonlyscan=False))
-        return noScanList
+        aqps_list = self.generateAQPsList(query, self.selectSettings(query, no_scan_settings))
+        return self.removeDuplicatePlans(query, aqps_list)
+
+    def generateNoOperatorAQPsList(self, query):
+        aqps_list = self.generateAQPsList(query, self.selectSettings(query, no_operator_settings))
+        return self.removeDuplicatePlans(query, aqps_list)
+
+    def generateAllAQPsLists(self, query):
+        """
+        Generates the no join, no scan and no operator AQPs together, so that in parallel mode
+        all of them run at the same time
+        """
+        join_settings, scan_settings, operator_settings = self.selectAllSettings(query)
+        aqps_list = self.generateAQPsList(query, join_settings + scan_settings + operator_settings)
+        scan_end = len(join_settings) + len(scan_settings)
+        return (self.removeDuplicatePlans(query, aqps_list[:len(join_settings)]),
+            self.removeDuplicatePlans(query, aqps_list[len(join_settings):scan_end]),
+            self.removeDuplicatePlans(query, aqps_list[scan_end:]))
+
+    def getMemorySettings(self, cursor):
+        """
+        Returns the session values of work_mem in kB and hash_mem_multiplier, None on servers without it
+        """
+        try:
+            cursor.execute("SELECT name, setting FROM pg_settings WHERE name IN ('work_mem', 'hash_mem_multiplier')")
+            memory_settings = {name: float(setting) for name, setting in cursor.fetchall()}
+        finally:
+            cursor.connection.rollback()
+        return memory_settings['work_mem'], memory_settings.get('hash_mem_multiplier')
+
+    def generateMemoryAQPsList(self, query, spills):
+        """
+        Analyzes a query again at each larger work_mem in work_mem_sweep, and each larger hash_mem_multiplier
+        in hash_mem_multiplier_sweep when spills, the getSpill values of the nodes of its QEP, has hashes.
+        Stops at the first plan where nothing spills, and does nothing when nothing spills in the QEP.
+        Returns (memory settings, plan) pairs, the smallest memory first
+        """
+        spills = set(spills) - {None}
+        if len(spills) == 0:
+            return []
+        with self.profile.phase("connect"):
+            cursor = self.connection.open()
+        work_mem, hash_mem_multiplier = self.getMemorySettings(cursor)
+        multipliers = [None]
+        if "hash" in spills and hash_mem_multiplier is not None and cursor.connection.server_version >= hash_mem_multiplier_version:
+            multipliers = [hash_mem_multiplier] + [value for value in hash_mem_multiplier_sweep if value > hash_mem_multiplier]
+
+        memory_aqps = []
+        timeout = self.getTimeBudget()
+        with self.profile.phase("memory sweep"):
+            for work_mem_value in [value for value in work_mem_sweep if value > work_mem]:
+                for multiplier in multipliers:
+                    memory = {"work_mem": work_mem_value}
+                    if multiplier is not None:
+                        memory["hash_mem_multiplier"] = multiplier
+                    with self.profile.phase("aqp", plan=getPlanName({}, memory), analyze=True):
+                        query_plan = self.getAQP(query, cursor=cursor, timeout=timeout, values=memory)
+                    memory_aqps.append((memory, query_plan))
+                    # A cancelled plan is only estimated, so it cannot tell whether anything spilled
+                    if 'Timed Out' not in query_plan[0][0][0] and all(getSpill(plan) is None for plan in walkPlan(query_plan)):
+                        return memory_aqps
+        return memory_aqps
+
+    def generateParallelAQPsList(self, query):
+        """
+        Generates the AQPs of a query whose QEP has parallel subtrees with the values of selectParallelValues.
+        Returns (settings, plan) pairs, the fewest workers first
+        """
+        if not self.hasParallelSubtrees(query):
+            return []
+        with self.profile.phase("connect"):
+            cursor = self.connection.open()
+        try:
+            cursor.execute("SHOW max_parallel_workers_per_gather")
+            session_workers = int(cursor.fetchone()[0])
+        finally:
+            cursor.connection.rollback()
+
+        analyze = self.mode == analyze_mode
+        timeout = self.getTimeBudget() if analyze else None
+        parallel_aqps = []
+        with self.profile.phase("parallel sweep"):
+            for values in self.selectParallelValues(session_workers):
+                with self.profile.phase("aqp", plan=getPlanName({}, values), analyze=analyze):
+                    parallel_aqps.append((values, self.getAQP(query, cursor=cursor, analyze=analyze, timeout=timeout,
+                        values=values)))
+        return parallel_aqps
 
     def getQueryResult(self, query):
         result = self.connection.execute(query)
         return result
 
-connection = DBConnection()
-print("PostgreSQL server information")
+    def getQueryResultPage(self, query, page, page_size=default_page_size):
+        return self.connection.fetchPage(query, page, page_size)
+
+    def getQueryRowCount(self, query):
+        return self.connection.countRows(query)
+
+    def close(self):
+        self.connection.close()
+
+def walkPlan(query_plan):
+    """
+    Yields every node of a plan in json format, parents before their children
+    """
+    stack = [query_plan[0][0][0]['Plan']]
+    while stack:
+        plan = stack.pop()
+        yield plan
+        stack.extend(reversed(plan.get('Plans', [])))
+
+def mergeRuns(runs, query_plan=None):
+    """
+    Writes the runs of a plan into query_plan, the first run by default. Each node gets the times of
+    its subtree in each run as Run Times, in ms over all loops, and the median of the runs as its
+    Actual Total Time. Runs that ended up with another plan are left out. Returns query_plan, or
+    the run that was cancelled if one was
+    """
+    for run in runs:
+        if 'Timed Out' in run[0][0][0]:
+            return run
+    if query_plan is None:
+        query_plan = runs[0]
+    fingerprint = getPlanFingerprint(query_plan)
+    runs = [run for run in runs if getPlanFingerprint(run) == fingerprint]
+    if len(runs) == 0:
+        return query_plan
+
+    top = query_plan[0][0][0]
+    top['Runs'] = len(runs)
+    top['Execution Time'] = statistics.median(run[0][0][0]['Execution Time'] for run in runs)
+    for plan, *run_plans in zip(walkPlan(query_plan), *[walkPlan(run) for run in runs]):
+        plan['Run Times'] = [run_plan['Actual Total Time'] * run_plan.get('Actual Loops', 1) for run_plan in run_plans]
+        # Nodes that never ran have no loops
+        loops = plan.get('Actual Loops', 1)
+        if loops > 0:
+            plan['Actual Total Time'] = statistics.median(plan['Run Times']) / loops
+    return query_plan
+
+def getReplicaParams(replica):
+    """
+    Returns the connection parameters of a replica given as a DSN, such as "host=localhost port=5433
+    dbname=TPC-H", or as a dict of the parameters of DBConnection
+    """
+    if isinstance(replica, str):
+        return dict(dsn=replica)
+    return dict(replica)
+
+def describeTableMismatch(table, first, other):
+    """
+    Describes how the (reltuples, relpages) of a table or index on a replica differ from the first replica,
+    or returns None when they are within replica_stats_tolerance of each other
+    """
+    if first is None or other is None:
+        return f"{table} {'only' if first is None else 'not'} on this replica"
+    for label, value, first_value in zip(("rows", "pages"), other, first):
+        if abs(value - first_value) > replica_stats_tolerance * max(abs(value), abs(first_value)):
+            return f"{table} has {round(value)} {label} against {round(first_value)}"
+    return None
+
+def getReplicaName(params):
+    """
+    Returns host:port/database of the connection parameters of a replica, which tags the plans it produced
+    """
+    if "dsn" in params:
+        params = psycopg2.extensions.parse_dsn(params["dsn"])
+    return f"{params.get('host', 'localhost')}:{params.get('port', 5432)}/{params.get('dbname', params.get('database'))}"
+
+def getSpill(plan):
+    """
+    Returns how a node of an analyzed plan spills to disk, "sort" for a sort that ran out of work_mem
+    and "hash" for a hash or hashed aggregate split into batches, or None if it stays in memory
+    """
+    if plan.get('Sort Space Type') == "Disk":
+        return "sort"
+    if plan.get('Hash Batches', 1) > 1 or plan.get('HashAgg Batches', 1) > 1:
+        return "hash"
+    return None
+
+def formatMemory(kilobytes):
+    """
+    Returns a memory size in kB the way Postgres shows it, such as 64MB
+    """
+    for unit, size in (("GB", 1048576), ("MB", 1024)):
+        if kilobytes >= size and kilobytes % size == 0:
+            return f"{int(kilobytes // size)}{unit}"
+    return f"{int(kilobytes)}kB"
+
+def getExplain(query, analyze, server_version):
+    """
+    Returns the EXPLAIN of a query. Analyzed plans report the buffers of each node and, with VERBOSE,
+    the time of each worker of parallel nodes. From PostgreSQL 12, plans also report the planner settings
+    that differ from their defaults
+    """
+    options = ["ANALYZE", "VERBOSE", "BUFFERS"] if analyze else []
+    if server_version >= explain_settings_version:
+        options.append("SETTINGS")
+    options.append("FORMAT JSON")
+    return f"EXPLAIN ({', '.join(options)}) {query}"
+
+def getOperatorName(node_type, strategy=None):
+    """
+    Returns the operator of a node, which tells apart the strategies of Aggregate nodes
+    """
+    if node_type == "Aggregate":
+        return aggregate_strategies.get(strategy, node_type)
+    return node_type
+
+def getPlanName(settings, values=None):
+    """
+    Returns the name of a plan from the planner settings it disables and the settings whose values it changes
+    """
+    names = [f"{name}=off" for name, value in settings.items() if not value]
+    for name, value in (values or {}).items():
+        names.append(f"{name}={formatMemory(value) if name == 'work_mem' else value}")
+    return ", ".join(names) if names else "QEP"
+
+def getPlanFingerprint(query_plan):
+    """
+    Returns a hash of the structure and operators of a plan, identical plans share a fingerprint
+    """
+    digest = hashlib.sha1()
+    stack = [query_plan[0][0][0]['Plan']]
+    while stack:
+        plan = stack.pop()
+        # None marks the end of a node's children
+        if plan is None:
+            digest.update(b")")
+            continue
+        digest.update(repr([plan.get(key) for key in plan_fingerprint_keys]).encode())
+        stack.append(None)
+        stack.extend(reversed(plan.get('Plans', [])))
+    return digest.hexdigest()
+
+def getPlanCost(query_plan):
+    """
+    Returns the planner's estimated total cost of a plan
+    """
+    return query_plan[0][0][0]['Plan']['Total Cost']
+
+def printServerInfo():
+    connection = DBConnection()
+    print("PostgreSQL server information")
+
+    record = connection.execute("SELECT version();")
+    print("You are connected to - ", record, "\n")
+    connection.close()
 
-record = connection.execute("SELECT version();")
-print("You are connected to - ", record, "\n")
\ No newline at end of file
+if __name__ == "__main__":
+    printServerInfo()
@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+class Profile:
+    """
+    Records the wall time of each phase of processing a query, and the planning, execution
+    and JIT time Postgres reports for each plan. Phases can be nested and can run on several
+    threads at once
+    """
+    def __init__(self) -> None:
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.spans = [] # One dict for each finished phase, in the order they finished
+        self.plan_times = [] # One dict for each plan, with the times Postgres reported
+
+    @contextmanager
+    def phase(self, name, **details):
+        """
+        Records the wall time spent inside the with block as a phase
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            span = dict(name=name, start_ms=(start - self.origin) * 1000, duration_ms=(end - start) * 1000,
+                thread=threading.get_ident(), pid=os.getpid(), details=details)
+            with self.lock:
+                self.spans.append(span)
+
+    def addPlanTimes(self, name, query_plan, **details):
+        """
+        Records the planning, execution and JIT time in ms of a plan in json format
+        """
+        top = query_plan[0][0][0]
+        jit_timing = top.get('JIT', {}).get('Timing', {})
+        plan_times = dict(name=name, details=details, planning_ms=top.get('Planning Time'),
+            execution_ms=top.get('Execution Time'), jit_ms=jit_timing.get('Total'), timed_out=top.get('Timed Out'))
+        with self.lock:
+            self.plan_times.append(plan_times)
+
+    def reset(self, name):
+        """
+        Drops the phases with this name, for phases that are repeated on every rerun of the page
+        """
+        with self.lock:
+            self.spans = [span for span in self.spans if span["name"] != name]
+
+    def summary(self):
+        """
+        Returns the total time, the number of runs and the longest run of each phase,
+        in the order the phases first started
+        """
+        totals = {}
+        for span in sorted(self.spans, key=lambda span: span["start_ms"]):
+            total = totals.setdefault(span["name"], dict(phase=span["name"], total_ms=0.0, count=0, max_ms=0.0))
+            total["total_ms"] += span["duration_ms"]
+            total["count"] += 1
+            total["max_ms"] = max(total["max_ms"], span["duration_ms"])
+        return list(totals.values())
+
+    def toTrace(self):
+        """
+        Returns the profile in the Trace Event Format, which can be opened in chrome://tracing or Perfetto
+        """
+        events = [dict(name=span["name"], ph="X", ts=span["start_ms"] * 1000, dur=span["duration_ms"] * 1000,
+            pid=span["pid"], tid=span["thread"], args={key: str(value) for key, value in span["details"].items()})
+            for span in self.spans]
+        events.extend(dict(name=f"postgres {plan_times['name']}", ph="i", s="g", ts=0, pid=os.getpid(), tid=0,
+            args={key: str(value) for key, value in plan_times.items()}) for plan_times in self.plan_times)
+        return dict(traceEvents=events, displayTimeUnit="ms")
+
+    def exportTrace(self, path):
+        with open(path, "w") as trace_file:
+            json.dump(self.toTrace(), trace_file)
+
+    def printProfile(self):
+        """
+        Prints the time spent in each phase and the times reported by Postgres
+        """
+        for total in self.summary():
+            print(f"{total['phase']:<24} {total['total_ms']:>10.2f} ms {total['count']:>4} runs")
+        for plan_times in self.plan_times:
+            print(f"{plan_times['name']:<24} planning {plan_times['planning_ms']} ms, " +
+                f"execution {plan_times['execution_ms']} ms, JIT {plan_times['jit_ms']} ms")